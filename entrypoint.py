@@ -1,6 +1,11 @@
 import os
 import json
+import datetime
+import functools
+import threading
+from decimal import Decimal
 import requests
+import numpy as np
 import pandas as pd
 import sqlalchemy as sa
 import google.oauth2.service_account
@@ -8,10 +13,25 @@ import googleapiclient.discovery
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import polyline
-from shapely.geometry import Point, Polygon
+import shapely
 import openmeteo_requests
 import requests_cache
 from retry_requests import retry
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba не установлена (extra "fast") — area определяются shapely.contains_xy по каждому
+    # полигону для точек из окна searchsorted по его bbox
+    njit = None
+    prange = range
+
+try:
+    import connectorx
+except ImportError:
+    # connectorx не установлен (extra "fast") — читаем через pd.read_sql
+    connectorx = None
 
 
 # Секреты MySQL
@@ -32,6 +52,22 @@ def get_google_creds() -> str:
     return url
 
 
+@functools.lru_cache(maxsize=None)
+def get_service_account_credentials(scopes):
+    """
+    Учетные данные сервисного аккаунта из переменной окружения google_service_account_json.
+    Кэшируются на время процесса: JSON разбирается один раз на каждый набор scopes.
+
+    Параметры:
+    scopes (tuple): Области доступа
+
+    Возвращает:
+    google.oauth2.service_account.Credentials
+    """
+    info = json.loads(get_google_creds(), strict=False)
+    return google.oauth2.service_account.Credentials.from_service_account_info(info, scopes=list(scopes))
+
+
 def read_sheet_data_to_pandas(service, spreadsheet_id: str, range_name: str):
     """
     Читает данные из Google Таблицы по указанному диапазону и преобразует их в Pandas DataFrame.
@@ -88,48 +124,80 @@ def read_sheet_data_to_pandas(service, spreadsheet_id: str, range_name: str):
         return None
 
 
-def get_sheets_service(service_account_file: str):
+def resolve_service_account_credentials(credentials, scopes):
+    """
+    Приводит учетные данные сервисного аккаунта к объекту Credentials
+
+    Параметры:
+    credentials: None (переменная окружения google_service_account_json), dict с
+                 разобранным JSON, объект Credentials или путь к JSON-файлу
+    scopes (tuple): Области доступа
+
+    Возвращает:
+    google.oauth2.service_account.Credentials
+    """
+    if credentials is None:
+        return get_service_account_credentials(scopes)
+    if isinstance(credentials, google.oauth2.service_account.Credentials):
+        return credentials.with_scopes(list(scopes))
+    if isinstance(credentials, dict):
+        return google.oauth2.service_account.Credentials.from_service_account_info(credentials, scopes=list(scopes))
+    return google.oauth2.service_account.Credentials.from_service_account_file(credentials, scopes=list(scopes))
+
+
+def get_sheets_service(credentials=None):
     """
     Создает и возвращает объект службы Google Sheets API.
+    По умолчанию учетные данные сервисного аккаунта берутся из переменной окружения
+    google_service_account_json, без чтения файла с диска.
 
     Args:
-        service_account_file: Путь к JSON-файлу учетных данных сервисного аккаунта.
+        credentials: Путь к JSON-файлу, dict или объект Credentials (необязательно).
 
     Returns:
         Объект googleapiclient.discovery.Resource для Sheets API.
     """
     try:
         # Определяем области доступа. Для чтения достаточно 'spreadsheets.readonly'.
-        SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+        SCOPES = ('https://www.googleapis.com/auth/spreadsheets.readonly',)
 
-        # Загружаем учетные данные сервисного аккаунта
-        creds = google.oauth2.service_account.Credentials.from_service_account_file(
-            service_account_file, scopes=SCOPES
-        )
+        # Загружаем учетные данные сервисного аккаунта (из окружения — кэшируются на время процесса)
+        creds = resolve_service_account_credentials(credentials, SCOPES)
 
-        # Строим сервис Sheets API
-        service = googleapiclient.discovery.build('sheets', 'v4', credentials=creds)
+        # Строим сервис Sheets API по встроенному discovery-документу, без HTTP-запроса и файлового кэша
+        service = googleapiclient.discovery.build('sheets', 'v4', credentials=creds,
+                                                  static_discovery=True, cache_discovery=False)
         print("Сервис Google Sheets API успешно инициализирован.")
         return service
     except Exception as e:
         print(f"Ошибка при инициализации сервиса Google Sheets API: {e}")
         return None
 
+def _json_safe_value(value):
+    # Значения object-колонок, которые json не сериализует (numeric из PostgreSQL, date/time)
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return value
+
 class GoogleSheetsManager:
     """
     Класс для управления Google Sheets с функцией очистки и записи данных
     """
 
-    def __init__(self, credentials_file, spreadsheet_id):
+    def __init__(self, credentials, spreadsheet_id):
         """
         Инициализация менеджера Google Sheets
 
         Параметры:
-        credentials_file (str): Путь к файлу с credentials сервисного аккаунта
+        credentials: Учетные данные сервисного аккаунта — путь к JSON-файлу, уже разобранный
+                     JSON (dict) или объект Credentials. Если None, используются учетные данные
+                     из переменной окружения google_service_account_json
         spreadsheet_id (str): ID Google таблицы
         """
         self.spreadsheet_id = spreadsheet_id
-        self.credentials_file = credentials_file
+        self.credentials = credentials
         self.service = self._authenticate()
 
     def _authenticate(self):
@@ -137,11 +205,10 @@ class GoogleSheetsManager:
         Аутентификация и создание сервиса Google Sheets
         """
         try:
-            credentials = google.oauth2.service_account.Credentials.from_service_account_file(
-                self.credentials_file,
-                scopes=['https://www.googleapis.com/auth/spreadsheets']
-            )
-            service = build('sheets', 'v4', credentials=credentials)
+            scopes = ('https://www.googleapis.com/auth/spreadsheets',)
+            credentials = resolve_service_account_credentials(self.credentials, scopes)
+            service = build('sheets', 'v4', credentials=credentials,
+                            static_discovery=True, cache_discovery=False)
             return service
         except Exception as e:
             print(f"Ошибка аутентификации: {e}")
@@ -225,7 +292,8 @@ class GoogleSheetsManager:
 
     def truncate_sheet_batch(self, sheet_name=None):
         """
-        Очищает лист с помощью batchUpdate (более эффективно для больших листов)
+        Очищает значения всего листа одним запросом values().batchClear
+        (форматирование и размеры листа не меняются)
 
         Параметры:
         sheet_name (str): Название листа для очистки
@@ -241,34 +309,20 @@ class GoogleSheetsManager:
                 print("❌ Не удалось получить метаданные листа")
                 return False
 
-            # Создаем запрос на очистку через repeatCell
-            requests = [{
-                "repeatCell": {
-                    "range": {
-                        "sheetId": sheet_meta['sheet_id'],
-                        "startRowIndex": 0,
-                        "endRowIndex": sheet_meta['row_count'],
-                        "startColumnIndex": 0,
-                        "endColumnIndex": sheet_meta['column_count']
-                    },
-                    "cell": {
-                        "userEnteredValue": None  # Очищаем значения
-                    },
-                    "fields": "userEnteredValue"
-                }
-            }]
+            # Диапазон из одного названия листа (в A1-нотации) — все ячейки листа
+            sheet_range = "'" + sheet_meta['title'].replace("'", "''") + "'"
 
             body = {
-                'requests': requests
+                'ranges': [sheet_range]
             }
 
-            # Выполняем batchUpdate
-            result = self.service.spreadsheets().batchUpdate(
+            # Выполняем batchClear
+            result = self.service.spreadsheets().values().batchClear(
                 spreadsheetId=self.spreadsheet_id,
                 body=body
             ).execute()
 
-            print(f"✅ Лист '{sheet_meta['title']}' успешно очищен (batchUpdate)")
+            print(f"✅ Лист '{sheet_meta['title']}' успешно очищен (batchClear)")
             return True
 
         except HttpError as error:
@@ -278,7 +332,9 @@ class GoogleSheetsManager:
             print(f"❌ Ошибка при batch очистке: {e}")
             return False
 
-    def _get_column_letter(self, column_number):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _get_column_letter(column_number):
         """
         Преобразует номер колонки в буквенное обозначение (1 -> A, 26 -> Z, 27 -> AA)
 
@@ -295,7 +351,80 @@ class GoogleSheetsManager:
             column_number //= 26
         return result
 
-    def write_dataframe(self, df, range_name, value_input_option='RAW', include_headers=True):
+    @staticmethod
+    def _dataframe_to_values(df, include_headers=True):
+        """
+        Готовит значения DataFrame для Sheets API по колонкам: только JSON-совместимые
+        Python-объекты (NaN/NaT -> '', Decimal -> float, даты -> строка)
+
+        Параметры:
+        df (pandas.DataFrame): DataFrame для записи
+        include_headers (bool): Добавлять ли строку заголовков
+
+        Возвращает:
+        list: Список строк (списков значений)
+        """
+        columns = []
+        for name in df.columns:
+            col = df[name]
+            if pd.api.types.is_datetime64_any_dtype(col):
+                col = col.dt.strftime('%Y-%m-%d %H:%M:%S')
+            elif col.dtype == object:
+                col = col.map(_json_safe_value)
+            # astype(object) отдает Python int/float вместо numpy-скаляров
+            columns.append(col.astype(object).where(col.notna(), ''))
+
+        values = [list(row) for row in zip(*columns)]
+        if include_headers:
+            values.insert(0, [str(name) for name in df.columns])
+        return values
+
+    @staticmethod
+    def _split_range(range_name, values, chunk_rows):
+        """
+        Делит значения на блоки по chunk_rows строк с диапазоном для каждого блока
+
+        Параметры:
+        range_name (str): Диапазон записи (например, 'Sheet1!A1' или 'Sheet1!A:D')
+        values (list): Строки для записи
+        chunk_rows (int): Строк в одном блоке
+
+        Возвращает:
+        list: Элементы data для values().batchUpdate
+        """
+        sheet, _, cells = range_name.rpartition('!')
+        start_cell = cells.split(':')[0]
+        start_col = start_cell.rstrip('0123456789')
+        start_row = int(start_cell[len(start_col):] or 1)
+        prefix = f"{sheet}!" if sheet else ""
+        return [
+            {'range': f"{prefix}{start_col}{start_row + i}", 'values': values[i:i + chunk_rows]}
+            for i in range(0, len(values), chunk_rows)
+        ]
+
+    @staticmethod
+    def _cell_data(value):
+        """
+        Значение ячейки для updateCells (аналог valueInputOption='RAW')
+
+        Параметры:
+        value: JSON-совместимое значение из _dataframe_to_values
+
+        Возвращает:
+        dict: CellData с userEnteredValue (пустой для '' и inf/-inf: numberValue их не принимает)
+        """
+        if isinstance(value, bool):
+            return {'userEnteredValue': {'boolValue': value}}
+        if isinstance(value, float) and not np.isfinite(value):
+            return {}
+        if isinstance(value, (int, float)):
+            return {'userEnteredValue': {'numberValue': value}}
+        if value == '':
+            return {}
+        return {'userEnteredValue': {'stringValue': str(value)}}
+
+    def write_dataframe(self, df, range_name, value_input_option='RAW', include_headers=True,
+                        chunk_rows=5000):
         """
         Записывает DataFrame в Google Sheets
 
@@ -304,32 +433,46 @@ class GoogleSheetsManager:
         range_name (str): Диапазон для записи (например, 'Sheet1!A1')
         value_input_option (str): 'RAW' или 'USER_ENTERED'
         include_headers (bool): Включать ли заголовки столбцов
+        chunk_rows (int): Большие DataFrame уходят блоками по chunk_rows строк
+                          в одном запросе values().batchUpdate
 
         Возвращает:
         dict: Результат операции или None в случае ошибки
         """
         try:
             # Подготовка данных
-            if include_headers:
-                values = [df.columns.values.tolist()] + df.values.tolist()
-            else:
-                values = df.values.tolist()
+            values = self._dataframe_to_values(df, include_headers)
 
-            # Создание тела запроса
-            body = {
-                'values': values
-            }
+            if len(values) <= chunk_rows:
+                # Создание тела запроса
+                body = {
+                    'values': values
+                }
 
-            # Запись данных
-            result = self.service.spreadsheets().values().update(
-                spreadsheetId=self.spreadsheet_id,
-                range=range_name,
-                valueInputOption=value_input_option,
-                body=body
-            ).execute()
+                # Запись данных
+                result = self.service.spreadsheets().values().update(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=range_name,
+                    valueInputOption=value_input_option,
+                    body=body
+                ).execute()
+
+                print(f"✅ Записано {result.get('updatedCells')} ячеек")
+                print(f"📊 Диапазон: {result.get('updatedRange')}")
+            else:
+                # Блоки по chunk_rows строк одним запросом batchUpdate
+                body = {
+                    'valueInputOption': value_input_option,
+                    'data': self._split_range(range_name, values, chunk_rows)
+                }
+
+                result = self.service.spreadsheets().values().batchUpdate(
+                    spreadsheetId=self.spreadsheet_id,
+                    body=body
+                ).execute()
 
-            print(f"✅ Записано {result.get('updatedCells')} ячеек")
-            print(f"📊 Диапазон: {result.get('updatedRange')}")
+                print(f"✅ Записано {result.get('totalUpdatedCells')} ячеек "
+                      f"({len(body['data'])} блоков)")
             print(f"📝 Заголовки: {'включены' if include_headers else 'не включены'}")
 
             return result
@@ -394,7 +537,7 @@ class GoogleSheetsManager:
             return False
 
     def truncate_and_write_with_resize(self, df, sheet_name=None, start_cell='A1',
-                                       include_headers=True):
+                                       include_headers=True, chunk_rows=5000):
         """
         Очищает лист и записывает данные, автоматически подгоняя размеры
 
@@ -403,6 +546,7 @@ class GoogleSheetsManager:
         sheet_name (str): Название листа
         start_cell (str): Начальная ячейка для записи
         include_headers (bool): Включать ли заголовки столбцов
+        chunk_rows (int): Данные уходят отдельными updateCells по chunk_rows строк
 
         Возвращает:
         bool: True если успешно, False в случае ошибки
@@ -418,9 +562,14 @@ class GoogleSheetsManager:
                 print("❌ Не удалось получить метаданные листа")
                 return False
 
+            # Начальная ячейка записи в индексах сетки (с 0)
+            start_col = start_cell.rstrip('0123456789')
+            start_row_index = int(start_cell[len(start_col):] or 1) - 1
+            start_col_index = sum((ord(ch) - 64) * 26 ** i for i, ch in enumerate(reversed(start_col.upper()))) - 1
+
             # Определяем необходимые размеры
-            required_rows = len(df) + (1 if include_headers else 0)
-            required_cols = len(df.columns)
+            required_rows = start_row_index + len(df) + (1 if include_headers else 0)
+            required_cols = start_col_index + len(df.columns)
 
             print(f"📊 Требуется строк: {required_rows}, столбцов: {required_cols}")
 
@@ -457,6 +606,22 @@ class GoogleSheetsManager:
                 }
             ]
 
+            # Записываем данные тем же запросом: очистка, размеры и запись — один round-trip;
+            # строки — блоками по chunk_rows, каждый своим updateCells
+            values = self._dataframe_to_values(df, include_headers)
+            for i, block in enumerate(self._split_range(start_cell, values, chunk_rows)):
+                requests.append({
+                    "updateCells": {
+                        "start": {
+                            "sheetId": sheet_meta['sheet_id'],
+                            "rowIndex": start_row_index + i * chunk_rows,
+                            "columnIndex": start_col_index
+                        },
+                        "rows": [{"values": [self._cell_data(v) for v in row]} for row in block['values']],
+                        "fields": "userEnteredValue"
+                    }
+                })
+
             # Выполняем batchUpdate
             body = {'requests': requests}
             self.service.spreadsheets().batchUpdate(
@@ -464,55 +629,420 @@ class GoogleSheetsManager:
                 body=body
             ).execute()
 
-            print("✅ Лист очищен и размеры скорректированы")
-
-            # Записываем данные
-            range_name = f"{sheet_meta['title']}!{start_cell}"
-            result = self.write_dataframe(
-                df=df,
-                range_name=range_name,
-                include_headers=include_headers
-            )
-
-            if result:
-                print("=" * 50)
-                print("🎉 Операция завершена успешно!")
-                return True
-            else:
-                return False
+            print("✅ Лист очищен, размеры скорректированы, данные записаны")
+            print("=" * 50)
+            print("🎉 Операция завершена успешно!")
+            return True
 
         except Exception as e:
             print(f"❌ Ошибка: {e}")
             return False
 
-def decode_polyline_to_tuples(encoded_polyline_string):
-    coordinates_tuples = polyline.decode(encoded_polyline_string)
-    return coordinates_tuples
+def _decode_polyline(encoded, precision):
+    # Google Encoded Polyline по байтам строки: 5-битные группы, zig-zag, дельты; результат (lng, lat)
+    n = encoded.shape[0]
+    out = np.empty((n // 2, 2), dtype=np.float64)
+    factor = 10.0 ** precision
+    lat = 0
+    lng = 0
+    index = 0
+    k = 0
+    while index < n:
+        for coord in range(2):
+            result = 0
+            shift = 0
+            while True:
+                byte = np.int64(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            change = ~(result >> 1) if result & 1 else result >> 1
+            if coord == 0:
+                lat += change
+            else:
+                lng += change
+        out[k, 0] = lng / factor
+        out[k, 1] = lat / factor
+        k += 1
+    return out[:k]
+
+decode_polyline_nb = njit(cache=True)(_decode_polyline) if njit is not None else None
+
+def decode_polyline_to_array(encoded_polyline_string):
+    # Сразу (x=lng, y=lat) в непрерывном массиве float64 (N, 2)
+    if decode_polyline_nb is not None:
+        return decode_polyline_nb(np.frombuffer(encoded_polyline_string.encode('ascii'), dtype=np.uint8), 5)
+    coordinates = polyline.decode(encoded_polyline_string, geojson=True)
+    return np.ascontiguousarray(coordinates, dtype=np.float64).reshape(-1, 2)
+
+def build_area_index(df_areas):
+    """
+    Готовит area к поиску точек: подготовленные (prepared) полигоны shapely и те же
+    координаты одним плоским массивом float64 с offsets и bbox (minx, miny, maxx, maxy),
+    плюс общий bbox всех area.
 
-def poly_contains(df):
-    a = df['area_detail_tuple']
-    b = df['parking_detail_tuple']
-    res = Polygon(a).contains(Polygon(b))
-    return res
+    Area с пустой или вырожденной polyline (меньше 3 точек) остается в индексе на своем
+    месте пустым полигоном без координат (bbox из NaN) и не содержит ни одной точки:
+    все массивы индекса одной длины с area_id.
+    """
+    area_coords = [np.reshape(coords, (-1, 2)) for coords in df_areas['area_coords']]
+    valid = np.array([len(coords) >= 3 for coords in area_coords], dtype=bool)
+    area_coords = [coords if ok else coords[:0] for coords, ok in zip(area_coords, valid)]
+    lengths = np.array([len(coords) for coords in area_coords], dtype=np.int32)
+    poly_offsets = np.zeros(len(area_coords) + 1, dtype=np.int32)
+    poly_offsets[1:] = np.cumsum(lengths)
+    if area_coords:
+        poly_flat = np.ascontiguousarray(np.concatenate(area_coords), dtype=np.float64)
+    else:
+        poly_flat = np.empty((0, 2), dtype=np.float64)
+    # Все непустые полигоны одним вызовом shapely из плоского массива координат
+    area_polys = np.full(len(area_coords), shapely.Polygon(), dtype=object)
+    if valid.any():
+        ring_idx = np.repeat(np.arange(int(valid.sum())), lengths[valid])
+        area_polys[valid] = shapely.polygons(shapely.linearrings(poly_flat, indices=ring_idx))
+    shapely.prepare(area_polys)
+    poly_bboxes = shapely.bounds(area_polys).reshape(-1, 4)
+    if valid.any():
+        total_bbox = np.concatenate([poly_bboxes[valid, :2].min(axis=0), poly_bboxes[valid, 2:].max(axis=0)])
+    else:
+        total_bbox = np.full(4, np.nan)
+    return {
+        'area_id': df_areas['area_id'].to_numpy(),
+        'area_name': df_areas['area_name'].to_numpy(),
+        'polys': area_polys,
+        'poly_flat': poly_flat,
+        'poly_offsets': poly_offsets,
+        'poly_bboxes': poly_bboxes,
+        'total_bbox': total_bbox
+    }
+
+def _points_in_polys(poly_flat, poly_offsets, poly_bboxes, xs, ys, out_area_idx):
+    # Ray casting (even-odd): для каждой точки индекс первого полигона, в который она попала, иначе -1
+    n_polys = poly_offsets.shape[0] - 1
+    for k in prange(xs.shape[0]):
+        x = xs[k]
+        y = ys[k]
+        out_area_idx[k] = -1
+        for p in range(n_polys):
+            # Точка вне bbox полигона — ребра не проверяем
+            if x < poly_bboxes[p, 0] or x > poly_bboxes[p, 2] or y < poly_bboxes[p, 1] or y > poly_bboxes[p, 3]:
+                continue
+            start = poly_offsets[p]
+            end = poly_offsets[p + 1]
+            inside = False
+            j = end - 1
+            for i in range(start, end):
+                xi = poly_flat[i, 0]
+                yi = poly_flat[i, 1]
+                xj = poly_flat[j, 0]
+                yj = poly_flat[j, 1]
+                if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                    inside = not inside
+                j = i
+            if inside:
+                out_area_idx[k] = p
+                break
+
+points_in_polys = njit(cache=True, parallel=True)(_points_in_polys) if njit is not None else None
+# Ядро запускается и из потоков ThreadPoolExecutor: слой workqueue numba не допускает одновременных
+# запусков. Пул потоков numba поднимается первым вызовом assign_area в главном потоке (блок КВТ).
+points_in_polys_lock = threading.Lock()
+
+def assign_area(df, lng_col, lat_col, area_index):
+    """
+    Определяет area для каждой точки без cross join. С numba — JIT ray casting по всем
+    точкам, без нее — shapely.contains_xy по каждому полигону (параллельно в потоках),
+    только для точек из его bbox.
 
-def poly_contains_point_kvt(df):
-    start_point = Point(df['g_lat'], df['g_lng'])
-    area_poly = Polygon(df['area_poly'])
-    res = area_poly.contains(start_point)
-    return res
+    Добавляет в df (на месте) колонку area_id: по умолчанию 0, для точек внутри area — ее id.
+    Название area подставляется уже после группировки (add_area_name).
+    """
+    lng = df[lng_col].to_numpy(dtype=np.float64)
+    lat = df[lat_col].to_numpy(dtype=np.float64)
+
+    # Точки вне общего bbox всех area отсекаем сразу, пространственная проверка — только для остальных
+    minx, miny, maxx, maxy = area_index['total_bbox']
+    in_bbox = np.flatnonzero((lng >= minx) & (lng <= maxx) & (lat >= miny) & (lat <= maxy))
+    lng = np.ascontiguousarray(lng[in_bbox])
+    lat = np.ascontiguousarray(lat[in_bbox])
+
+    if points_in_polys is not None:
+        area_idx = np.empty(len(in_bbox), dtype=np.int64)
+        with points_in_polys_lock:
+            points_in_polys(area_index['poly_flat'], area_index['poly_offsets'], area_index['poly_bboxes'],
+                            lng, lat, area_idx)
+    else:
+        # Точки отсортированы по lng: кандидаты полигона — срез searchsorted по его bbox
+        order = np.argsort(lng, kind='stable')
+        lng_sorted = lng[order]
+
+        def points_in_poly(p):
+            if shapely.is_empty(area_index['polys'][p]):
+                return np.empty(0, dtype=np.intp)
+            minx, miny, maxx, maxy = area_index['poly_bboxes'][p]
+            start = np.searchsorted(lng_sorted, minx, side='left')
+            end = np.searchsorted(lng_sorted, maxx, side='right')
+            candidates = order[start:end]
+            candidates = candidates[(lat[candidates] >= miny) & (lat[candidates] <= maxy)]
+            return candidates[shapely.contains_xy(area_index['polys'][p], lng[candidates], lat[candidates])]
+
+        # contains_xy отпускает GIL внутри GEOS — полигоны считаем параллельно в потоках
+        with ThreadPoolExecutor() as executor:
+            hits = list(executor.map(points_in_poly, range(len(area_index['polys']))))
+
+        # Если точка попала в несколько area, берем первую: пишем с конца, первые перезаписывают
+        area_idx = np.full(len(in_bbox), -1, dtype=np.int64)
+        for p in reversed(range(len(hits))):
+            area_idx[hits[p]] = p
+
+    hit = area_idx >= 0
+    point_idx = in_bbox[hit]
+    poly_idx = area_idx[hit]
+    area_id = np.zeros(len(df), dtype=area_index['area_id'].dtype)
+    area_id[point_idx] = area_index['area_id'][poly_idx]
+    df['area_id'] = area_id
+
+def add_area_name(df, area_index):
+    """
+    Добавляет (на месте) колонку area_name по area_id сразу после area_id: группировки
+    идут по целочисленному area_id, строки названий подставляются уже в агрегат.
+    Для area_id = 0 (точка вне area) — '0'.
+    """
+    names = pd.Series(area_index['area_name'], index=area_index['area_id'])
+    df.insert(df.columns.get_loc('area_id') + 1, 'area_name', df['area_id'].map(names).fillna('0'))
 
-def poly_contains_point_orders(df):
-    start_point = Point(df['start_lat'], df['start_lng'])
-    area_poly = Polygon(df['area_poly'])
-    res = area_poly.contains(start_point)
-    return res
+def nearest_points(lat, lng, ref_lat, ref_lng, chunk_elements=1_000_000):
+    """
+    Для каждой точки находит ближайшие опорные точки (например, парковки) по дуге большого круга.
+
+    Считает то же, что SQL acos(cos(lat1)*cos(lat2)*cos(lng2 - lng1) + sin(lat1)*sin(lat2))
+    с RANK() = 1: ближайшая та, у которой аргумент acos наибольший, при равенстве
+    возвращаются все такие. acos берётся только от максимума. Точки без координат пропускаются.
+    Матрица точки × опорные точки считается кусками строк, каждый не больше chunk_elements
+    элементов: промежуточных массивов такого размера несколько, поэтому память не растёт
+    с числом опорных точек.
+
+    Параметры:
+    lat, lng (array-like): координаты точек в градусах
+    ref_lat, ref_lng (array-like): координаты опорных точек в градусах
+    chunk_elements (int): сколько элементов матрицы считать за раз
+
+    Возвращает:
+    tuple: (индексы точек, индексы опорных точек, угловое расстояние в радианах)
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    ref_lat = np.radians(np.asarray(ref_lat, dtype=np.float64))
+    ref_lng = np.radians(np.asarray(ref_lng, dtype=np.float64))
+    if len(lat) == 0 or len(ref_lat) == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+
+    chunk_rows = max(1, chunk_elements // len(ref_lat))
+    cos_ref_lat = np.cos(ref_lat)
+    sin_ref_lat = np.sin(ref_lat)
+    point_idx, ref_idx, distance = [], [], []
+    for start in range(0, len(lat), chunk_rows):
+        chunk_lat = lat[start:start + chunk_rows, None]
+        chunk_lng = lng[start:start + chunk_rows, None]
+        cos_dist = np.cos(chunk_lat) * cos_ref_lat * np.cos(ref_lng - chunk_lng) + np.sin(chunk_lat) * sin_ref_lat
+        cos_dist[np.isnan(cos_dist)] = -np.inf
+        cos_max = cos_dist.max(axis=1)
+        rows, cols = np.nonzero((cos_dist == cos_max[:, None]) & np.isfinite(cos_max)[:, None])
+        point_idx.append(rows + start)
+        ref_idx.append(cols)
+        distance.append(np.arccos(np.clip(cos_max[rows], -1.0, 1.0)))
+    return np.concatenate(point_idx), np.concatenate(ref_idx), np.concatenate(distance)
+
+def read_sql(sql, engine, params=None):
+    """
+    Читает результат запроса в DataFrame. С connectorx — колоночной бинарной выгрузкой
+    (Arrow -> pandas) без построчного создания Python-объектов, иначе через pd.read_sql.
 
-def poly_contains_point_open_app(df):
-    start_point = Point(df['lat'], df['lng'])
-    area_poly = Polygon(df['area_poly'])
-    res = area_poly.contains(start_point)
+    Параметры:
+    params (dict): bind-параметры (:name) запроса; connectorx их не поддерживает,
+                   поэтому такие запросы всегда идут через pd.read_sql
+    """
+    if params is not None:
+        return pd.read_sql(sa.text(sql), engine, params=params)
+    if connectorx is not None:
+        url = engine.url.set(drivername=engine.url.get_backend_name())
+        return connectorx.read_sql(url.render_as_string(hide_password=False), sql, return_type='pandas')
+    return pd.read_sql(sql, engine)
+
+def _read_sql_chunks(sql, engine, chunksize):
+    """
+    Отдает результат запроса порциями DataFrame по chunksize строк, не буферизуя весь
+    результат в драйвере.
+
+    Для диалектов с серверными курсорами (psycopg) — stream_results. mysqlconnector
+    в SQLAlchemy серверных курсоров не поддерживает и открывает соединения с buffered=True,
+    поэтому для него берется небуферизованный курсор драйвера (cursor(buffered=False)):
+    строки читаются из сокета по мере fetchmany. Если генератор закрыт до конца результата
+    или упал, соединение с недочитанными строками инвалидируется, а не возвращается в пул.
+    """
+    if engine.dialect.supports_server_side_cursors:
+        with engine.connect().execution_options(stream_results=True) as connection:
+            yield from pd.read_sql(sql, connection, chunksize=chunksize)
+        return
+    dbapi_conn = engine.raw_connection()
+    exhausted = False
+    try:
+        if engine.dialect.driver == 'mysqlconnector':
+            cursor = dbapi_conn.cursor(buffered=False)
+        else:
+            cursor = dbapi_conn.cursor()
+        try:
+            cursor.execute(sql)
+            columns = [col[0] for col in cursor.description]
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    exhausted = True
+                    break
+                # Как pd.read_sql: Decimal -> float
+                yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        finally:
+            if exhausted:
+                cursor.close()
+            else:
+                # Остались непрочитанные строки: close() небуферизованного курсора бросит
+                # "Unread result found" и скроет исходную ошибку, а само соединение
+                # с висящим результатом в пул возвращать нельзя
+                try:
+                    cursor.close()
+                except Exception as e:
+                    print(f"Курсор закрыт с ошибкой: {e}")
+                dbapi_conn.invalidate()
+    finally:
+        dbapi_conn.close()
+
+def read_sql_area_agg(sql, con, lng_col, lat_col, area_index, agg, chunksize=200_000, daily=False):
+    """
+    Читает результат запроса порциями, определяет area и сразу агрегирует каждую порцию
+    по ['timestamp_hour', 'city_id', 'area_id'], area_name добавляется к итогу. В памяти
+    одновременно только одна порция сырых строк и частичные агрегаты.
+
+    Параметры:
+    agg (dict): агрегаты в формате DataFrame.agg, только аддитивные ('count', 'sum')
+    daily (bool): агрегировать сразу по дням — ключ 'start_day' (полночь timestamp_hour)
+                  вместо 'timestamp_hour'
+
+    Возвращает:
+    pandas.DataFrame: агрегаты с ключами группировки в колонках
+    """
+    time_key = 'start_day' if daily else 'timestamp_hour'
+    keys = [time_key, 'city_id', 'area_id']
+    cat_cols = ['city_id']
+    parts = []
+    if isinstance(con, sa.engine.Engine):
+        # Драйвер отдает строки порциями, а не буферизует весь результат
+        chunks = _read_sql_chunks(sql, con, chunksize)
+    else:
+        chunks = pd.read_sql(sql, con, chunksize=chunksize)
+    for chunk in chunks:
+        assign_area(chunk, lng_col, lat_col, area_index)
+        if daily:
+            chunk['start_day'] = pd.to_datetime(chunk['timestamp_hour']).dt.normalize()
+        # groupby по category хеширует целочисленные коды
+        for c in cat_cols:
+            chunk[c] = chunk[c].astype('category')
+        parts.append(chunk.groupby(keys, observed=True, sort=False).agg(agg))
+    if not parts:
+        res = pd.DataFrame(columns=keys + list(agg))
+    else:
+        res = pd.concat(parts).groupby(level=keys, observed=True, sort=False).sum().reset_index()
+        # Возвращаем исходные типы, чтобы merge и to_sql работали как раньше
+        for c in cat_cols:
+            if isinstance(res[c].dtype, pd.CategoricalDtype):
+                res[c] = res[c].astype(res[c].cat.categories.dtype)
+    add_area_name(res, area_index)
     return res
 
+def _copy_rows(dbapi_conn, table_name, columns, rows):
+    """
+    Записывает строки в таблицу через COPY FROM STDIN (psycopg 3).
+
+    Параметры:
+    dbapi_conn: соединение psycopg
+    table_name (str): имя таблицы (уже в кавычках, если нужно)
+    columns (list): имена колонок
+    rows: итератор кортежей значений
+    """
+    columns_sql = ', '.join(f'"{c}"' for c in columns)
+    with dbapi_conn.cursor() as cur:
+        with cur.copy(f"COPY {table_name} ({columns_sql}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+
+
+def psql_insert_copy(table, conn, keys, data_iter):
+    """
+    Метод вставки для DataFrame.to_sql: строки уходят в PostgreSQL одним потоком
+    COPY FROM STDIN (psycopg 3) вместо INSERT на каждую строку.
+    """
+    table_name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+    _copy_rows(conn.connection, table_name, keys, data_iter)
+
+
+def to_int_columns(df, columns):
+    """
+    Приводит (на месте) целочисленные по смыслу колонки к Int64. После merge, fillna или
+    NULL из базы они приходят как float64 (3.0) или Decimal, а COPY в целочисленную
+    колонку принимает только "3". Дробное значение дает ошибку, а не тихое округление.
+    """
+    for c in columns:
+        df[c] = pd.to_numeric(df[c]).astype('Int64')
+
+
+def replace_table_rows(engine, table_name, delete_sql, df, constants=None):
+    """
+    Заменяет данные таблицы одной транзакцией.
+
+    Новые строки сначала заливаются через COPY во временную staging-таблицу,
+    затем в одной транзакции выполняются очистка (DELETE/TRUNCATE) и
+    INSERT ... SELECT из staging. Пока идёт заливка, старые строки не тронуты,
+    а читатели никогда не видят таблицу пустой.
+
+    Параметры:
+    engine: SQLAlchemy engine PostgreSQL
+    table_name (str): таблица назначения
+    delete_sql (str): запрос очистки старых данных
+    df (pandas.DataFrame): новые строки, колонки совпадают с колонками таблицы
+    constants (dict): колонки с одним значением на все строки, {колонка: значение};
+        подставляются параметрами в INSERT, а не повторяются в каждой строке COPY
+    """
+    constants = constants or {}
+    stg_name = f'{table_name}_stg'
+    columns_sql = ', '.join(f'"{c}"' for c in df.columns)
+    insert_columns_sql = ', '.join([columns_sql] + [f'"{c}"' for c in constants])
+    select_sql = ', '.join([columns_sql] + [f':const_{i}' for i in range(len(constants))])
+    params = {f'const_{i}': value for i, value in enumerate(constants.values())}
+
+    with engine.begin() as connection:
+        # Даты с часовым поясом (например, NOW() без AT TIME ZONE) переводим в пояс сессии:
+        # COPY в колонку timestamp без пояса молча отбросил бы смещение, а INSERT раньше
+        # приводил такие значения через TimeZone сессии
+        tz_cols = [c for c in df.columns if isinstance(df[c].dtype, pd.DatetimeTZDtype)]
+        if tz_cols:
+            session_tz = connection.execute(sa.text('SHOW TIME ZONE')).scalar()
+            df = df.assign(**{c: df[c].dt.tz_convert(session_tz).dt.tz_localize(None) for c in tz_cols})
+        # Python-объекты вместо numpy-скаляров, NaN/NaT -> NULL
+        rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+        # Типы колонок staging берём из целевой таблицы, без ограничений и identity
+        connection.execute(sa.text(
+            f'CREATE TEMP TABLE "{stg_name}" ON COMMIT DROP AS '
+            f'SELECT {columns_sql} FROM {table_name} WITH NO DATA'
+        ))
+        _copy_rows(connection.connection, f'"{stg_name}"', df.columns, rows)
+        connection.execute(sa.text(delete_sql))
+        connection.execute(sa.text(
+            f'INSERT INTO {table_name} ({insert_columns_sql}) SELECT {select_sql} FROM "{stg_name}"'
+        ), params)
+    print(f'Таблица {table_name} успешно обновлена!')
+
+
 def main():
 
     url = get_mysql_url()
@@ -525,16 +1055,10 @@ def main():
     url = url.set(drivername="postgresql+psycopg")
     engine_postgresql = sa.create_engine(url)
 
-    google_service_account_json = get_google_creds()
-
-    with open('google_json.json', 'w') as fp:
-        json.dump(json.loads(google_service_account_json, strict=False), fp)
-    generated_json_file = './google_json.json'
-
     # Загрузка в t_area_kvt_history. Начало
     select_kvt = '''
         SELECT 
-            NOW() AT TIME ZONE 'Europe/Athens' AS "timestamp" ,
+            --NOW() AT TIME ZONE 'Europe/Athens' AS "timestamp" ,
             --tb."timestamp" ,
             --date_trunc('hour', tb."timestamp") AS "timestamp_hour" ,
             date_trunc('hour', (NOW() AT TIME ZONE 'Europe/Athens')) AS "timestamp_hour" ,
@@ -550,7 +1074,6 @@ def main():
             --AND 
             tb.error_status IN (0,7)
     '''
-    df_kvt = pd.read_sql(select_kvt, engine_postgresql)
 
     # Выгрузка areas
     select_areas = '''
@@ -562,27 +1085,27 @@ def main():
         FROM damir.t_area ta
         WHERE ta."name" LIKE '%%| Area |%%'
     '''
-    df_areas = pd.read_sql(select_areas, engine_postgresql)
 
-    # area в полигоны
-    df_areas['area_poly'] = df_areas['area_detail'].apply(decode_polyline_to_tuples)
-
-    df_kvt_area = df_kvt.merge(df_areas, how='cross')
-    df_kvt_area['res'] = df_kvt_area.apply(poly_contains_point_kvt, axis=1)
+    # КВТ и areas читаем параллельно
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_kvt = executor.submit(read_sql, select_kvt, engine_postgresql)
+        future_areas = executor.submit(read_sql, select_areas, engine_postgresql)
+        df_kvt = future_kvt.result()
+        df_areas = future_areas.result()
 
-    df_kvt_area_res = df_kvt_area[df_kvt_area['res'] == True]
+    # area в полигоны
+    # Исходная polyline-строка после разбора не нужна — pop сразу освобождает колонку
+    df_areas['area_coords'] = df_areas.pop('area_detail').map(decode_polyline_to_array)
+    area_index = build_area_index(df_areas)
 
-    df_kvt_area_res = df_kvt_area_res.drop(
-        columns=['timestamp', 'city_id', 'g_lat', 'g_lng', 'area_detail', 'area_poly', 'res'])
-    df_kvt_area_res = df_kvt.merge(df_kvt_area_res, how='left', on=['timestamp_hour', 'id'])
-    df_kvt_area_res['area_id'] = df_kvt_area_res['area_id'].fillna(0)
-    df_kvt_area_res['area_name'] = df_kvt_area_res['area_name'].fillna('0')
+    assign_area(df_kvt, 'g_lng', 'g_lat', area_index)
 
-    df_kvt_area_res = df_kvt_area_res.groupby(['timestamp_hour', 'city_id', 'area_id', 'area_name']) \
+    df_kvt_area_res = df_kvt.groupby(['timestamp_hour', 'city_id', 'area_id'], observed=True, sort=False) \
         .agg({'id': 'count'}) \
         .rename(columns={'id': 'kvt'}) \
         .reset_index()
-    df_kvt_area_res['add_time'] = pd.Timestamp.now()
+    add_area_name(df_kvt_area_res, area_index)
+    to_int_columns(df_kvt_area_res, ['city_id'])
 
     # Очистка таблицы
     truncate_area_kvt_history = '''
@@ -590,16 +1113,8 @@ def main():
         WHERE takh."timestamp_hour" >= date_trunc('hour', (NOW() AT TIME ZONE 'Europe/Athens'));
     '''
 
-    with engine_postgresql.connect() as connection:
-        with connection.begin() as transaction:
-            print(f"Попытка очистить таблицу")
-            # Очистка t_bike
-            connection.execute(sa.text(truncate_area_kvt_history))
-            # Если ошибок нет, транзакция фиксируется автоматически
-            print(f"Таблица area_kvt_history успешно очищена!")
-
-    df_kvt_area_res.to_sql("t_area_kvt_history", engine_postgresql, if_exists="append", index=False)
-    print('Таблица t_area_kvt_history успешно обновлена!')
+    replace_table_rows(engine_postgresql, "t_area_kvt_history", truncate_area_kvt_history, df_kvt_area_res,
+                       constants={'add_time': datetime.datetime.now()})
 
     # Загрузка в t_area_kvt_history. Конец
 
@@ -620,7 +1135,7 @@ def main():
             date_trunc('hour', res.created) AS timestamp_hour,
             res.city_id ,
             res.id ,
-            res.user_id ,
+            --res.user_id ,
             res.open_lat AS lat ,
             res.open_lng AS lng
         FROM 
@@ -660,34 +1175,23 @@ def main():
         WHERE res.rn = 1
     '''
 
-    df_app_open = pd.read_sql(select_app_open, engine_postgresql)
+    df_app_open = read_sql(select_app_open, engine_postgresql)
 
     # Соединяю открытия приложения и area
-    df_app_open_area = df_app_open.merge(df_areas, how='cross')
-
-    df_app_open_area['res'] = df_app_open_area.apply(poly_contains_point_open_app, axis=1)
-    df_app_open_area = df_app_open_area[df_app_open_area['res'] == True]
-    df_app_open_res = df_app_open[['timestamp_hour', 'city_id', 'id']].merge(
-        df_app_open_area[['area_id', 'area_name', 'id']], on='id', how='left')
-    df_app_open_res['area_id'] = df_app_open_res['area_id'].fillna(0)
-    df_app_open_res['area_name'] = df_app_open_res['area_name'].fillna('0')
-    df_app_open_res = df_app_open_res.groupby(['timestamp_hour', 'city_id', 'area_id', 'area_name'], as_index=False) \
+    assign_area(df_app_open, 'lng', 'lat', area_index)
+    df_app_open_res = df_app_open.groupby(['timestamp_hour', 'city_id', 'area_id'], as_index=False,
+                                          observed=True, sort=False) \
         .agg({'id': 'count'}) \
         .rename(columns={'id': 'open_app'})
-    df_app_open_res['add_time'] = pd.Timestamp.now()
+    add_area_name(df_app_open_res, area_index)
+    to_int_columns(df_app_open_res, ['city_id'])
 
     truncate_t_area_open_app_history = '''
         DELETE FROM damir.t_area_open_app_history
         WHERE damir.t_area_open_app_history."timestamp_hour" >= date_trunc('day', NOW() AT TIME ZONE 'Europe/Athens') - INTERVAL '1 days';
         '''
-    with engine_postgresql.connect() as connection:
-        with connection.begin() as transaction:
-            connection.execute(sa.text(truncate_t_area_open_app_history))
-            transaction.commit()
-            print(f"Таблица t_area_open_app_history успешно очищена!")
-
-    df_app_open_res.to_sql("t_area_open_app_history", engine_postgresql, if_exists="append", index=False)
-    print('Таблица t_area_open_app_history успешно обновлена!')
+    replace_table_rows(engine_postgresql, "t_area_open_app_history", truncate_t_area_open_app_history, df_app_open_res,
+                       constants={'add_time': datetime.datetime.now()})
 
     # Загрузка в t_area_open_app_history. Конец
 
@@ -699,7 +1203,7 @@ def main():
 
     select_kvt = '''
         SELECT 
-            res_tab."timestamp" ,
+            --res_tab."timestamp" ,
             res_tab.timestamp_hour ,
             res_tab.id ,
             res_tab.city_id ,
@@ -722,37 +1226,8 @@ def main():
             ) AS res_tab
         WHERE res_tab.rn = 1
     '''
-    df_kvt = pd.read_sql(select_kvt, engine_postgresql)
-
-    # Выгрузка areas
-    select_areas = '''
-        SELECT
-            --ta.city_id ,
-            ta.id AS area_id ,
-            ta."name" AS area_name ,
-            ta.detail AS area_detail
-        FROM damir.t_area ta
-        WHERE ta."name" LIKE '%%| Area |%%'
-    '''
-    df_areas = pd.read_sql(select_areas, engine_postgresql)
-    # area в полигоны
-    df_areas['area_poly'] = df_areas['area_detail'].apply(decode_polyline_to_tuples)
-
-    df_kvt_area = df_kvt.merge(df_areas, how='cross')
-    df_kvt_area['res'] = df_kvt_area.apply(poly_contains_point_kvt, axis=1)
-    df_kvt_area_res = df_kvt_area[df_kvt_area['res'] == True]
-    df_kvt_area_res = df_kvt_area_res.drop(
-        columns=['timestamp', 'city_id', 'g_lat', 'g_lng', 'area_detail', 'area_poly', 'res'])
-
-    df_kvt_area_res = df_kvt.merge(df_kvt_area_res, how='left', on=['timestamp_hour', 'id'])
-    df_kvt_area_res['area_id'] = df_kvt_area_res['area_id'].fillna(0)
-    df_kvt_area_res['area_name'] = df_kvt_area_res['area_name'].fillna('0')
-
-    df_kvt_area_res = df_kvt_area_res.groupby(['timestamp_hour', 'city_id', 'area_id', 'area_name']) \
-        .agg({'id': 'count'}) \
-        .rename(columns={'id': 'kvt'}) \
-        .reset_index()
 
+    # area уже загружены и разобраны в блоке t_area_kvt_history — используем тот же area_index
     # Выгрузка заказов
     select_orders = '''
         SELECT 
@@ -770,28 +1245,6 @@ def main():
         WHERE tor."timestamp" >= date_trunc('hour', NOW() AT TIME ZONE 'Europe/Athens') - INTERVAL '2 hours'
     '''
 
-    df_orders = pd.read_sql(select_orders, engine_postgresql)
-    # Соединяю orders и area
-    df_orders_area = df_orders.merge(df_areas, how='cross')
-    df_orders_area['res'] = df_orders_area.apply(poly_contains_point_orders, axis=1)
-    df_orders_area = df_orders_area[df_orders_area['res'] == True]
-    df_orders_area = df_orders_area.drop(
-        columns=['city_id', 'start_lat', 'start_lng', 'ride_amount', 'discount', 'bike_discount_amount',
-                 'subscription_price', 'area_detail', 'area_poly', 'res'])
-    df_orders_areas_res = df_orders.merge(df_orders_area, on=['timestamp_hour', 'id'], how='left')
-    df_orders_areas_res['area_id'] = df_orders_areas_res['area_id'].fillna(0)
-    df_orders_areas_res['area_name'] = df_orders_areas_res['area_name'].fillna('0')
-    df_orders_areas_res = df_orders_areas_res.groupby(['timestamp_hour', 'city_id', 'area_id', 'area_name']) \
-        .agg({'id': 'count',
-              'ride_amount': 'sum',
-              'discount': 'sum',
-              'bike_discount_amount': 'sum', 'subscription_price': 'sum'}) \
-        .rename(columns={'id': 'poezdok',
-                         'ride_amount': 'obzchaya_stoimost',
-                         'discount': 'oplacheno_bonusami',
-                         'bike_discount_amount': 'skidka',
-                         'subscription_price': 'abon'}) \
-        .reset_index()
     # Выгрузка показателей для распределения
     select_distr = '''
         WITH dolgi AS (
@@ -815,12 +1268,25 @@ def main():
                     FROM damir.t_bike_use tbu
                     LEFT JOIN t_bike tb ON tbu.bid = tb.id
                     WHERE tbu.ride_status = 2 
-                        AND to_timestamp( tbu.start_time) >= date_trunc('hour', NOW() AT TIME ZONE 'Europe/Athens') - INTERVAL '2 hours'
+                        AND to_timestamp( tbu.start_time) >= :since
                         --AND to_timestamp( tbu.start_time) >= '2025-12-18'::date
                     ) AS dolgi ON tpd.ride_id = dolgi.id 
                 ) AS dolgi
             GROUP BY dolgi.city_id
         ),
+        -- поездки по городам за день: считаются один раз и используются для обеих пропорций
+        poezdki_po_gorodam AS (
+            SELECT 
+                TO_CHAR(TO_TIMESTAMP(t_bike_use.start_time), 'YYYY-MM-DD') AS start_time,
+                t_bike.city_id,
+                COUNT(t_bike_use.ride_amount) AS poezdok
+            FROM damir.t_bike_use
+            LEFT JOIN damir.t_bike ON t_bike_use.bid = t_bike.id
+            WHERE t_bike_use.ride_status != 5 
+                AND TO_TIMESTAMP(t_bike_use.start_time) >= :since
+                --AND TO_TIMESTAMP(t_bike_use.start_time) >= '2025-12-18'::date
+            GROUP BY 1, 2
+        ),
         vyruchka_s_abonementov AS (
             SELECT 
                 distr_poezdki_po_gorodam.city_id,
@@ -833,20 +1299,7 @@ def main():
                     distr_poezdki_po_gorodam.poezdok,
                     -- Приведение к numeric важно, чтобы результат деления не был 0
                     distr_poezdki_po_gorodam.poezdok::numeric / SUM(distr_poezdki_po_gorodam.poezdok) OVER (PARTITION BY distr_poezdki_po_gorodam.start_time) AS coef_goroda
-                FROM 
-                    (
-                    SELECT 
-                        TO_CHAR(TO_TIMESTAMP(t_bike_use.start_time), 'YYYY-MM-DD') AS start_time,
-                        t_bike.city_id,
-                        COUNT(t_bike_use.ride_amount) AS poezdok
-                    FROM damir.t_bike_use
-                    LEFT JOIN damir.t_bike ON t_bike_use.bid = t_bike.id
-                    WHERE t_bike_use.ride_status != 5 
-                        AND TO_TIMESTAMP(t_bike_use.start_time) >= date_trunc('hour', NOW() AT TIME ZONE 'Europe/Athens') - INTERVAL '2 hours'
-                        --AND TO_TIMESTAMP(t_bike_use.start_time) >= '2025-12-18'::date
-                    GROUP BY 1, 2
-                    ) 
-                    AS distr_poezdki_po_gorodam
+                FROM poezdki_po_gorodam AS distr_poezdki_po_gorodam
             ) AS distr_poezdki_po_gorodam
             LEFT JOIN (
                 SELECT 
@@ -855,7 +1308,7 @@ def main():
                 FROM damir.t_trade
                 WHERE t_trade.type = 6 
                     AND t_trade.status = 1 
-                    AND t_trade.date >= date_trunc('hour', NOW() AT TIME ZONE 'Europe/Athens') - INTERVAL '2 hours'
+                    AND t_trade.date >= :since
                     --AND t_trade.date >= '2025-12-18'::date
                 GROUP BY 1
                 ) AS sum_uspeh_abon
@@ -872,18 +1325,7 @@ def main():
                     dp.city_id,
                     dp.poezdok,
                     dp.poezdok::numeric / NULLIF(SUM(COALESCE(dp.poezdok, 0)) OVER (PARTITION BY dp.start_time), 0) AS coef_goroda
-                FROM (
-                    SELECT 
-                        TO_CHAR(TO_TIMESTAMP(t_bike_use.start_time), 'YYYY-MM-DD') AS start_time,
-                        t_bike.city_id,
-                        COUNT(t_bike_use.ride_amount) AS poezdok
-                    FROM damir.t_bike_use
-                    LEFT JOIN damir.t_bike ON t_bike_use.bid = t_bike.id
-                    WHERE t_bike_use.ride_status != 5 
-                        AND TO_TIMESTAMP(t_bike_use.start_time) >= date_trunc('hour', NOW() AT TIME ZONE 'Europe/Athens') - INTERVAL '2 hours'
-                        --AND TO_TIMESTAMP(t_bike_use.start_time) >= '2025-12-18'::date
-                    GROUP BY 1, 2
-                ) AS dp
+                FROM poezdki_po_gorodam AS dp
             ) AS distr_poezdki_po_gorodam
             LEFT JOIN (
                 SELECT 
@@ -892,7 +1334,7 @@ def main():
                 FROM damir.t_subscription_mapping
                 LEFT JOIN damir.t_subscription ON t_subscription_mapping.subscription_id = t_subscription.id
                 WHERE 
-                    t_subscription_mapping.start_time >= date_trunc('hour', NOW() AT TIME ZONE 'Europe/Athens') - INTERVAL '2 hours'
+                    t_subscription_mapping.start_time >= :since
                     --t_subscription_mapping.start_time >= '2025-12-18'::date 
                 GROUP BY 1
             ) AS sum_mnogor_abon
@@ -907,27 +1349,47 @@ def main():
         FULL JOIN vyruchka_s_abonementov ON dolgi.city_id = vyruchka_s_abonementov.city_id 
         FULL JOIN sum_mnogor_abon ON COALESCE(dolgi.city_id , vyruchka_s_abonementov.city_id ) = sum_mnogor_abon.city_id 
     '''
-    df_distr = pd.read_sql(select_distr, engine_postgresql)
+
+    # Начало окна distr (текущий час по Афинам минус 2 часа) — один bind-параметр на все CTE
+    distr_since = pd.Timestamp.now(tz='Europe/Athens').tz_localize(None).floor('h') - pd.Timedelta(hours=2)
+
+    # КВТ, заказы (с привязкой к area) и distr не зависят друг от друга — читаем параллельно
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        future_kvt = executor.submit(read_sql_area_agg, select_kvt, engine_postgresql, 'g_lng', 'g_lat',
+                                     area_index, {'id': 'count'})
+        future_orders = executor.submit(read_sql_area_agg, select_orders, engine_postgresql,
+                                        'start_lng', 'start_lat', area_index,
+                                        {'id': 'count',
+                                         'ride_amount': 'sum',
+                                         'discount': 'sum',
+                                         'bike_discount_amount': 'sum', 'subscription_price': 'sum'})
+        future_distr = executor.submit(read_sql, select_distr, engine_postgresql,
+                                       {'since': distr_since.to_pydatetime()})
+        df_kvt_area_res = future_kvt.result().rename(columns={'id': 'kvt'})
+        df_orders_areas_res = future_orders.result() \
+            .rename(columns={'id': 'poezdok',
+                             'ride_amount': 'obzchaya_stoimost',
+                             'discount': 'oplacheno_bonusami',
+                             'bike_discount_amount': 'skidka',
+                             'subscription_price': 'abon'})
+        df_distr = future_distr.result()
 
     # Соединяю основную таблицу с таблицей distr
     df_orders_areas_res = df_orders_areas_res.merge(df_distr, how='left', on='city_id')
-    # Преобразование типов
-    df_orders_areas_res['dolgi'] = pd.to_numeric(df_orders_areas_res['dolgi'], errors='coerce')
-    df_orders_areas_res['vyruchka_s_abonementov'] = pd.to_numeric(df_orders_areas_res['vyruchka_s_abonementov'], errors='coerce')
-    df_orders_areas_res['sum_mnogor_abon'] = pd.to_numeric(df_orders_areas_res['sum_mnogor_abon'], errors='coerce')
-    # Преобразование типов
-    df_orders_areas_res['dolgi'] = df_orders_areas_res['dolgi'].fillna(0)
-    df_orders_areas_res['vyruchka_s_abonementov'] = df_orders_areas_res['vyruchka_s_abonementov'].fillna(0)
-    df_orders_areas_res['sum_mnogor_abon'] = df_orders_areas_res['sum_mnogor_abon'].fillna(0)
-    df_orders_areas_res = df_orders_areas_res.assign(
-        cum_poezdok=df_orders_areas_res.groupby('city_id')['poezdok'].transform('sum'))
-    df_orders_areas_res['dolgi_res'] = df_orders_areas_res['dolgi'] * df_orders_areas_res['poezdok'] / \
-                                       df_orders_areas_res['cum_poezdok']
-    df_orders_areas_res['vyruchka_s_abonementov_res'] = df_orders_areas_res['vyruchka_s_abonementov'] * \
-                                                        df_orders_areas_res['poezdok'] / df_orders_areas_res[
-                                                            'cum_poezdok']
-    df_orders_areas_res['sum_mnogor_abon_res'] = df_orders_areas_res['sum_mnogor_abon'] * df_orders_areas_res[
-        'poezdok'] / df_orders_areas_res['cum_poezdok']
+    # Преобразование типов: numeric из PostgreSQL (Decimal) -> float, пропуски после merge -> 0
+    distr_cols = ['dolgi', 'vyruchka_s_abonementov', 'sum_mnogor_abon']
+    for c in distr_cols:
+        df_orders_areas_res[c] = pd.to_numeric(df_orders_areas_res[c], errors='coerce').fillna(0)
+    # Доля поездок area в городе, считается один раз на все три показателя
+    poezdok = df_orders_areas_res['poezdok'].to_numpy(dtype=np.float64)
+    # Поездки по городу: маленькая таблица сумм и map по city_id вместо transform
+    city_poezdok = df_orders_areas_res.groupby('city_id', observed=True, sort=False)['poezdok'].sum()
+    cum_poezdok = df_orders_areas_res['city_id'].map(city_poezdok).to_numpy(dtype=np.float64)
+    # Города без поездок (cum_poezdok == 0) получают долю 0, без деления на ноль
+    scale = np.divide(poezdok, cum_poezdok, out=np.zeros_like(poezdok), where=cum_poezdok != 0)
+    df_orders_areas_res[['dolgi_res', 'vyruchka_s_abonementov_res', 'sum_mnogor_abon_res']] = \
+        df_orders_areas_res[distr_cols].to_numpy(dtype=np.float64) * \
+        scale[:, None]
     # Соединяю КВТ и orders
     df_orders_kvt_area_res = df_kvt_area_res.merge(df_orders_areas_res, how='left',
                                                    on=['timestamp_hour', 'city_id', 'area_id', 'area_name'])
@@ -948,29 +1410,17 @@ def main():
         .rename(columns={'dolgi_res': 'dolgi',
                          'vyruchka_s_abonementov_res': 'vyruchka_s_abonementov',
                          'sum_mnogor_abon_res': 'sum_mnogor_abon'})
-    df_orders_kvt_area_res['poezdok'] = df_orders_kvt_area_res['poezdok'].fillna(0).astype(float)
-    df_orders_kvt_area_res['obzchaya_stoimost'] = df_orders_kvt_area_res['obzchaya_stoimost'].fillna(0).astype(float)
-    df_orders_kvt_area_res['oplacheno_bonusami'] = df_orders_kvt_area_res['oplacheno_bonusami'].fillna(0).astype(float)
-    df_orders_kvt_area_res['skidka'] = df_orders_kvt_area_res['skidka'].fillna(0).astype(float)
-    df_orders_kvt_area_res['abon'] = df_orders_kvt_area_res['abon'].fillna(0).astype(float)
-    df_orders_kvt_area_res['dolgi'] = df_orders_kvt_area_res['dolgi'].fillna(0)
-    df_orders_kvt_area_res['vyruchka_s_abonementov'] = df_orders_kvt_area_res['vyruchka_s_abonementov'].fillna(0)
-    df_orders_kvt_area_res['sum_mnogor_abon'] = df_orders_kvt_area_res['sum_mnogor_abon'].fillna(0)
-
-    df_orders_kvt_area_res['add_time'] = pd.Timestamp.now()
+    num_cols = ['poezdok', 'obzchaya_stoimost', 'oplacheno_bonusami', 'skidka', 'abon',
+                'dolgi', 'vyruchka_s_abonementov', 'sum_mnogor_abon']
+    df_orders_kvt_area_res[num_cols] = df_orders_kvt_area_res[num_cols].fillna(0).astype(float)
+    to_int_columns(df_orders_kvt_area_res, ['city_id', 'kvt', 'poezdok'])
 
     truncate_t_area_revenue_stats2 = '''
         DELETE FROM damir.t_area_revenue_stats2
         WHERE damir.t_area_revenue_stats2."timestamp_hour" >= date_trunc('hour', NOW() AT TIME ZONE 'Europe/Athens') - INTERVAL '2 hours';
         '''
-    with engine_postgresql.connect() as connection:
-        with connection.begin() as transaction:
-            connection.execute(sa.text(truncate_t_area_revenue_stats2))
-            transaction.commit()
-            print(f"Таблица t_area_revenue_stats2 успешно очищена!")
-
-    df_orders_kvt_area_res.to_sql("t_area_revenue_stats2", engine_postgresql, if_exists="append", index=False)
-    print('Таблица t_area_revenue_stats2 успешно обновлена!')
+    replace_table_rows(engine_postgresql, "t_area_revenue_stats2", truncate_t_area_revenue_stats2, df_orders_kvt_area_res,
+                       constants={'add_time': datetime.datetime.now()})
 
     # Выгрузка t_area_revenue_stats2 pandas. Конец
 
@@ -1052,8 +1502,6 @@ def main():
         GROUP BY takh.timestamp_hour::date , takh.city_id , takh.area_id , takh.area_name
         ORDER BY takh.timestamp_hour::date ASC
     '''
-    df_kvt_area_res = pd.read_sql(select_kvt_area_res, engine_postgresql)
-    df_kvt_area_res['start_day'] = pd.to_datetime(df_kvt_area_res['start_day'])
 
     select_open_app_res = '''
         SELECT 
@@ -1068,8 +1516,6 @@ def main():
         GROUP BY taoah.timestamp_hour::date , taoah.city_id , taoah.area_id , taoah.area_name
         ORDER BY taoah.timestamp_hour::date ASC
     '''
-    df_open_app_area_res = pd.read_sql(select_open_app_res, engine_postgresql)
-    df_open_app_area_res['start_day'] = pd.to_datetime(df_open_app_area_res['start_day'])
 
     # Выгрузка заказов
     select_orders = '''
@@ -1077,7 +1523,7 @@ def main():
             -- NOW() AS add_time ,
             STR_TO_DATE(DATE_FORMAT(from_unixtime(tbu.`date`), '%Y-%m-%d %H:00:00'), "%Y-%m-%d %H:%i:%s") AS timestamp_hour ,
             -- tbu.`date`,
-            from_unixtime(tbu.`date`) AS "timestamp" ,
+            -- from_unixtime(tbu.`date`) AS "timestamp" ,
             tbu.id ,
             tb.city_id ,
             tbu.start_lat ,
@@ -1096,42 +1542,8 @@ def main():
             -- from_unixtime(tbu.`date`) >= STR_TO_DATE(DATE_FORMAT(NOW(), '%Y-%m-%d %H:00:00'), "%Y-%m-%d %H:%i:%s") - INTERVAL 2 HOUR
              tbu.`date` >= UNIX_TIMESTAMP(DATE_SUB(CURDATE(), INTERVAL 1 DAY))
                 -- AND tbu.`date` <= UNIX_TIMESTAMP(NOW())
-        ORDER BY tbu.`date`ASC
     '''
 
-    df_orders = pd.read_sql(select_orders, engine_mysql)
-
-    # Соединяю orders и area
-    df_orders_area = df_orders.merge(df_areas, how='cross')
-    df_orders_area['res'] = df_orders_area.apply(poly_contains_point_orders, axis=1)
-    df_orders_area = df_orders_area[df_orders_area['res'] == True]
-    df_orders_area = df_orders_area.drop(
-        columns=['city_id', 'start_lat', 'start_lng', 'ride_amount', 'discount', 'bike_discount_amount',
-                 'subscription_price', 'area_detail', 'area_poly', 'res'])
-    df_orders_areas_res = df_orders.merge(df_orders_area, on=['timestamp_hour', 'id'], how='left')
-    df_orders_areas_res['area_id'] = df_orders_areas_res['area_id'].fillna(0)
-    df_orders_areas_res['area_name'] = df_orders_areas_res['area_name'].fillna('0')
-    df_orders_areas_res = df_orders_areas_res.groupby(['timestamp_hour', 'city_id', 'area_id', 'area_name']) \
-        .agg({'id': 'count',
-              'ride_amount': 'sum',
-              'discount': 'sum',
-              'bike_discount_amount': 'sum', 'subscription_price': 'sum'}) \
-        .rename(columns={'id': 'poezdok',
-                         'ride_amount': 'obzchaya_stoimost',
-                         'discount': 'oplacheno_bonusami',
-                         'bike_discount_amount': 'skidka',
-                         'subscription_price': 'abon'}) \
-        .reset_index()
-
-    # Собираю все в один день
-    df_orders_areas_res['start_day'] = pd.to_datetime(df_orders_areas_res['timestamp_hour'].dt.date)
-    df_orders_areas_res = df_orders_areas_res.groupby(['start_day', 'city_id', 'area_id', 'area_name'], as_index=False) \
-        .agg({'poezdok': 'sum',
-              'obzchaya_stoimost': 'sum',
-              'oplacheno_bonusami': 'sum',
-              'skidka': 'sum',
-              'abon': 'sum'})
-
     # Выгрузка показателей для распределения
     select_distr = '''
         WITH dolgi AS (
@@ -1158,11 +1570,24 @@ def main():
                     LEFT JOIN t_bike tb ON tbu.bid = tb.id
                     WHERE tbu.ride_status = 2 
                         --AND to_timestamp( tbu.start_time) >= date_trunc('hour', NOW() + INTERVAL '2 hours') - INTERVAL '2 hours'
-                        AND to_timestamp( tbu.start_time) >= date_trunc('day', (NOW() AT TIME ZONE 'Europe/Athens')) - INTERVAL '1 days'
+                        AND to_timestamp( tbu.start_time) >= :since
                     ) AS dolgi ON tpd.ride_id = dolgi.id
                 ) AS dolgi 
             GROUP BY dolgi.timestamp_day , dolgi.city_id
         ),
+        -- поездки по городам за день: считаются один раз и используются для обеих пропорций
+        poezdki_po_gorodam AS (
+            SELECT 
+                TO_CHAR(TO_TIMESTAMP(t_bike_use.start_time), 'YYYY-MM-DD') AS start_time,
+                t_bike.city_id,
+                COUNT(t_bike_use.ride_amount) AS poezdok
+            FROM damir.t_bike_use
+            LEFT JOIN damir.t_bike ON t_bike_use.bid = t_bike.id
+            WHERE t_bike_use.ride_status != 5 
+                --AND TO_TIMESTAMP(t_bike_use.start_time) >= date_trunc('hour', NOW() + INTERVAL '2 hours') - INTERVAL '2 hours'
+                AND TO_TIMESTAMP(t_bike_use.start_time) >= :since
+            GROUP BY 1, 2
+        ),
         vyruchka_s_abonementov AS (
             SELECT 
                 distr_poezdki_po_gorodam.start_time::date AS start_time,
@@ -1176,19 +1601,7 @@ def main():
                     distr_poezdki_po_gorodam.poezdok,
                     -- Приведение к numeric важно, чтобы результат деления не был 0
                     distr_poezdki_po_gorodam.poezdok::numeric / SUM(distr_poezdki_po_gorodam.poezdok) OVER (PARTITION BY distr_poezdki_po_gorodam.start_time) AS coef_goroda
-                FROM 
-                    (
-                    SELECT 
-                        TO_CHAR(TO_TIMESTAMP(t_bike_use.start_time), 'YYYY-MM-DD') AS start_time,
-                        t_bike.city_id,
-                        COUNT(t_bike_use.ride_amount) AS poezdok
-                    FROM damir.t_bike_use
-                    LEFT JOIN damir.t_bike ON t_bike_use.bid = t_bike.id
-                    WHERE t_bike_use.ride_status != 5 
-                        --AND TO_TIMESTAMP(t_bike_use.start_time) >= date_trunc('hour', NOW() + INTERVAL '2 hours') - INTERVAL '2 hours'
-                        AND TO_TIMESTAMP(t_bike_use.start_time) >= date_trunc('day', (NOW() AT TIME ZONE 'Europe/Athens')) - INTERVAL '1 days'
-                    GROUP BY 1, 2
-                    ) AS distr_poezdki_po_gorodam
+                FROM poezdki_po_gorodam AS distr_poezdki_po_gorodam
             ) AS distr_poezdki_po_gorodam
             LEFT JOIN (
                 SELECT 
@@ -1198,7 +1611,7 @@ def main():
                 WHERE t_trade.type = 6 
                     AND t_trade.status = 1 
                     --AND t_trade.date >= date_trunc('hour', NOW() + INTERVAL '2 hours') - INTERVAL '2 hours'
-                    AND t_trade.date >= date_trunc('day', (NOW() AT TIME ZONE 'Europe/Athens')) - INTERVAL '1 days'
+                    AND t_trade.date >= :since
                 GROUP BY 1
                 ) AS sum_uspeh_abon
                 ON distr_poezdki_po_gorodam.start_time = sum_uspeh_abon.start_time
@@ -1215,18 +1628,7 @@ def main():
                     dp.city_id,
                     dp.poezdok,
                     dp.poezdok::numeric / NULLIF(SUM(COALESCE(dp.poezdok, 0)) OVER (PARTITION BY dp.start_time), 0) AS coef_goroda
-                FROM (
-                    SELECT 
-                        TO_CHAR(TO_TIMESTAMP(t_bike_use.start_time), 'YYYY-MM-DD') AS start_time,
-                        t_bike.city_id,
-                        COUNT(t_bike_use.ride_amount) AS poezdok
-                    FROM damir.t_bike_use
-                    LEFT JOIN damir.t_bike ON t_bike_use.bid = t_bike.id
-                    WHERE t_bike_use.ride_status != 5 
-                        --AND TO_TIMESTAMP(t_bike_use.start_time) >= date_trunc('hour', NOW() + INTERVAL '2 hours') - INTERVAL '2 hours'
-                        AND TO_TIMESTAMP(t_bike_use.start_time) >= date_trunc('day', (NOW() AT TIME ZONE 'Europe/Athens')) - INTERVAL '1 days'
-                    GROUP BY 1, 2
-                ) AS dp
+                FROM poezdki_po_gorodam AS dp
             ) AS distr_poezdki_po_gorodam
             LEFT JOIN (
                 SELECT 
@@ -1236,7 +1638,7 @@ def main():
                 LEFT JOIN damir.t_subscription ON t_subscription_mapping.subscription_id = t_subscription.id
                 WHERE 
                     --t_subscription_mapping.start_time >= date_trunc('hour', NOW() + INTERVAL '2 hours') - INTERVAL '2 hours'
-                    t_subscription_mapping.start_time >= date_trunc('day', (NOW() AT TIME ZONE 'Europe/Athens')) - INTERVAL '1 days' 
+                    t_subscription_mapping.start_time >= :since 
                     GROUP BY 1
                 ) AS sum_mnogor_abon
                 ON distr_poezdki_po_gorodam.start_time = sum_mnogor_abon.start_time
@@ -1252,23 +1654,53 @@ def main():
         FULL JOIN sum_mnogor_abon ON COALESCE(dolgi.city_id , vyruchka_s_abonementov.city_id ) = sum_mnogor_abon.city_id AND COALESCE(dolgi.start_time , vyruchka_s_abonementov.start_time ) = sum_mnogor_abon.start_time
     '''
 
-    df_distr = pd.read_sql(select_distr, engine_postgresql)
+    # Начало окна distr (вчерашний день по Афинам) — один bind-параметр на все CTE
+    distr_since = pd.Timestamp.now(tz='Europe/Athens').tz_localize(None).normalize() - pd.Timedelta(days=1)
+
+    # КВТ и open_app из истории, заказы из MySQL (с привязкой к area, суммы сразу по дням) и distr
+    # не зависят друг от друга — читаем параллельно
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        future_kvt = executor.submit(read_sql, select_kvt_area_res, engine_postgresql)
+        future_open_app = executor.submit(read_sql, select_open_app_res, engine_postgresql)
+        future_orders = executor.submit(read_sql_area_agg, select_orders, engine_mysql,
+                                        'start_lng', 'start_lat', area_index,
+                                        {'id': 'count',
+                                         'ride_amount': 'sum',
+                                         'discount': 'sum',
+                                         'bike_discount_amount': 'sum', 'subscription_price': 'sum'},
+                                        daily=True)
+        future_distr = executor.submit(read_sql, select_distr, engine_postgresql,
+                                       {'since': distr_since.to_pydatetime()})
+        df_kvt_area_res = future_kvt.result()
+        df_open_app_area_res = future_open_app.result()
+        df_orders_areas_res = future_orders.result() \
+            .rename(columns={'id': 'poezdok',
+                             'ride_amount': 'obzchaya_stoimost',
+                             'discount': 'oplacheno_bonusami',
+                             'bike_discount_amount': 'skidka',
+                             'subscription_price': 'abon'})
+        df_distr = future_distr.result()
+
+    df_kvt_area_res['start_day'] = pd.to_datetime(df_kvt_area_res['start_day'])
+    df_open_app_area_res['start_day'] = pd.to_datetime(df_open_app_area_res['start_day'])
     df_distr['start_day'] = pd.to_datetime(df_distr['start_day'])
 
     # Соединяю основную таблицу с таблицей distr
     df_orders_areas_res = df_orders_areas_res.merge(df_distr, how='left', on=['start_day', 'city_id'])
-    df_orders_areas_res['dolgi'] = df_orders_areas_res['dolgi'].fillna(0)
-    df_orders_areas_res['vyruchka_s_abonementov'] = df_orders_areas_res['vyruchka_s_abonementov'].fillna(0)
-    df_orders_areas_res['sum_mnogor_abon'] = df_orders_areas_res['sum_mnogor_abon'].fillna(0)
-    df_orders_areas_res = df_orders_areas_res.assign(
-        cum_poezdok=df_orders_areas_res.groupby('city_id')['poezdok'].transform('sum'))
-    df_orders_areas_res['dolgi_res'] = df_orders_areas_res['dolgi'] * df_orders_areas_res['poezdok'] / \
-                                       df_orders_areas_res['cum_poezdok']
-    df_orders_areas_res['vyruchka_s_abonementov_res'] = df_orders_areas_res['vyruchka_s_abonementov'] * \
-                                                        df_orders_areas_res['poezdok'] / df_orders_areas_res[
-                                                            'cum_poezdok']
-    df_orders_areas_res['sum_mnogor_abon_res'] = df_orders_areas_res['sum_mnogor_abon'] * df_orders_areas_res[
-        'poezdok'] / df_orders_areas_res['cum_poezdok']
+    # Преобразование типов: numeric из PostgreSQL (Decimal) -> float, пропуски после merge -> 0
+    distr_cols = ['dolgi', 'vyruchka_s_abonementov', 'sum_mnogor_abon']
+    for c in distr_cols:
+        df_orders_areas_res[c] = pd.to_numeric(df_orders_areas_res[c], errors='coerce').fillna(0)
+    # Доля поездок area в городе, считается один раз на все три показателя
+    poezdok = df_orders_areas_res['poezdok'].to_numpy(dtype=np.float64)
+    # Поездки по городу: маленькая таблица сумм и map по city_id вместо transform
+    city_poezdok = df_orders_areas_res.groupby('city_id', observed=True, sort=False)['poezdok'].sum()
+    cum_poezdok = df_orders_areas_res['city_id'].map(city_poezdok).to_numpy(dtype=np.float64)
+    # Города без поездок (cum_poezdok == 0) получают долю 0, без деления на ноль
+    scale = np.divide(poezdok, cum_poezdok, out=np.zeros_like(poezdok), where=cum_poezdok != 0)
+    df_orders_areas_res[['dolgi_res', 'vyruchka_s_abonementov_res', 'sum_mnogor_abon_res']] = \
+        df_orders_areas_res[distr_cols].to_numpy(dtype=np.float64) * \
+        scale[:, None]
 
     # Соединяю КВТ и orders
     df_orders_kvt_area_res = df_kvt_area_res.merge(df_orders_areas_res, how='left',
@@ -1296,119 +1728,92 @@ def main():
                          'vyruchka_s_abonementov_res': 'vyruchka_s_abonementov',
                          'sum_mnogor_abon_res': 'sum_mnogor_abon'})
 
-    df_orders_kvt_area_res['open_app'] = df_orders_kvt_area_res['open_app'].fillna(0).astype(float)
-    df_orders_kvt_area_res['kvt'] = df_orders_kvt_area_res['kvt'].fillna(0).astype(float)
-    df_orders_kvt_area_res['poezdok'] = df_orders_kvt_area_res['poezdok'].fillna(0).astype(float)
-    df_orders_kvt_area_res['obzchaya_stoimost'] = df_orders_kvt_area_res['obzchaya_stoimost'].fillna(0).astype(float)
-    df_orders_kvt_area_res['oplacheno_bonusami'] = df_orders_kvt_area_res['oplacheno_bonusami'].fillna(0).astype(float)
-    df_orders_kvt_area_res['skidka'] = df_orders_kvt_area_res['skidka'].fillna(0).astype(float)
-    df_orders_kvt_area_res['abon'] = df_orders_kvt_area_res['abon'].fillna(0).astype(float)
-    df_orders_kvt_area_res['dolgi'] = df_orders_kvt_area_res['dolgi'].fillna(0)
-    df_orders_kvt_area_res['vyruchka_s_abonementov'] = df_orders_kvt_area_res['vyruchka_s_abonementov'].fillna(0)
-    df_orders_kvt_area_res['sum_mnogor_abon'] = df_orders_kvt_area_res['sum_mnogor_abon'].fillna(0)
-    df_orders_kvt_area_res['add_time'] = pd.Timestamp.now()
-
+    num_cols = ['open_app', 'kvt', 'poezdok', 'obzchaya_stoimost', 'oplacheno_bonusami', 'skidka', 'abon',
+                'dolgi', 'vyruchka_s_abonementov', 'sum_mnogor_abon']
+    df_orders_kvt_area_res[num_cols] = df_orders_kvt_area_res[num_cols].fillna(0).astype(float)
+    to_int_columns(df_orders_kvt_area_res, ['city_id', 'area_id', 'open_app', 'kvt', 'poezdok'])
     df_orders_kvt_area_res.rename(columns={'start_day': 'timestamp_hour'}, inplace=True)
 
     truncate_t_area_revenue_stats3 = '''
         DELETE FROM damir.t_area_revenue_stats3
         WHERE damir.t_area_revenue_stats3."timestamp_hour" >= date_trunc('day', (NOW() AT TIME ZONE 'Europe/Athens')) - INTERVAL '1 days';
         '''
-    with engine_postgresql.connect() as connection:
-        with connection.begin() as transaction:
-            connection.execute(sa.text(truncate_t_area_revenue_stats3))
-            transaction.commit()
-            print(f"Таблица t_area_revenue_stats3 успешно очищена!")
-
-
-    df_orders_kvt_area_res.to_sql("t_area_revenue_stats3", engine_postgresql, if_exists="append", index=False)
-    print('Таблица t_area_revenue_stats3 успешно обновлена!')
+    replace_table_rows(engine_postgresql, "t_area_revenue_stats3", truncate_t_area_revenue_stats3, df_orders_kvt_area_res,
+                       constants={'add_time': datetime.datetime.now()})
 
     # Выгрузка t_area_revenue_stats3 pandas. Конец
 
     # Выгрузка t_last_kvt pandas. Начало
     # Копирую t_last_kvt
-    select_t_last_kvt = '''
-        WITH kvt AS (
-            SELECT 
-                res.city_id ,
-                res.parking_id ,
-                res."name" AS parking_name ,
-                COUNT(res.id) AS kvt
-            FROM 
-            (
-                SELECT 
-                    tb.city_id ,
-                    tb.id ,
-                    tb.g_lat ,
-                    tb.g_lng ,
-                    ta.id AS parking_id ,
-                    ta."name" ,
-                    ta.lat ,
-                    ta.lng ,
-                    acos(
-                        cos(radians(tb.g_lat)) * 
-                        cos(radians(ta.lat)) * 
-                        cos(radians(ta.lng) - radians(tb.g_lng)) + 
-                        sin(radians(tb.g_lat)) * 
-                        sin(radians(ta.lat))
-                        ) AS distance ,
-                    RANK() OVER (PARTITION BY tb.id ORDER BY 6371000 * acos(
-                                                                            cos(radians(tb.g_lat)) * 
-                                                                            cos(radians(ta.lat)) * 
-                                                                            cos(radians(ta.lng) - radians(tb.g_lng)) + 
-                                                                            sin(radians(tb.g_lat)) * 
-                                                                            sin(radians(ta.lat))) ASC) AS rn
-                FROM damir.t_bike tb 
-                CROSS JOIN damir.t_area ta
-                WHERE tb.error_status IN (0,7)
-                    AND ta.active = 1
-                ) AS res
-            WHERE res.rn = 1
-                AND res.distance <= 15
-            GROUP BY res.city_id , res.parking_id , res."name"
-        ),
-        parking_all AS (
-            SELECT 
-                ta.city_id ,
-                ta.id AS parking_id ,
-                ta."name" AS parking_name
-            FROM damir.t_area ta
-            WHERE ta.active = 1
-        )
-        SELECT
-            NOW() AT TIME ZONE 'Europe/Athens' AS add_time ,
-            COALESCE(kvt.city_id , parking_all.city_id) AS city_id,
-            COALESCE(tap.area_id, 0) AS area_id,
-            COALESCE(tap.area_name, '0') AS area_name,
-            COALESCE(parking_all.parking_id , kvt.parking_id) AS parking_id,
-            COALESCE(parking_all.parking_name , kvt.parking_name) AS parking_name,
-            COALESCE(kvt.kvt, 0) AS kvt 
-        FROM parking_all
-        LEFT JOIN kvt ON parking_all.parking_id = kvt.parking_id
-        LEFT JOIN damir.t_areas_parkings tap ON COALESCE(parking_all.parking_id , kvt.parking_id) = tap.parking_id
+    # Ближайшая парковка для каждого самоката считается в numpy (nearest_points), а не
+    # CROSS JOIN t_bike × t_area с RANK() OVER в PostgreSQL
+    select_last_kvt_bikes = '''
+        SELECT 
+            tb.id ,
+            tb.city_id ,
+            tb.g_lat ,
+            tb.g_lng
+        FROM damir.t_bike tb 
+        WHERE tb.error_status IN (0,7)
+    '''
+    select_last_kvt_parkings = '''
+        SELECT 
+            ta.city_id ,
+            ta.id AS parking_id ,
+            ta."name" AS parking_name ,
+            ta.lat ,
+            ta.lng
+        FROM damir.t_area ta
+        WHERE ta.active = 1
     '''
-    df_t_last_kvt = pd.read_sql(select_t_last_kvt, engine_postgresql)
+    select_areas_parkings = '''
+        SELECT 
+            tap.parking_id ,
+            tap.area_id ,
+            tap.area_name
+        FROM damir.t_areas_parkings tap
+    '''
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        future_bikes = executor.submit(read_sql, select_last_kvt_bikes, engine_postgresql)
+        future_parkings = executor.submit(read_sql, select_last_kvt_parkings, engine_postgresql)
+        future_areas_parkings = executor.submit(read_sql, select_areas_parkings, engine_postgresql)
+        df_last_kvt_bikes = future_bikes.result()
+        df_last_kvt_parkings = future_parkings.result()
+        df_areas_parkings = future_areas_parkings.result()
+
+    bike_idx, parking_idx, distance = nearest_points(df_last_kvt_bikes['g_lat'], df_last_kvt_bikes['g_lng'],
+                                                     df_last_kvt_parkings['lat'], df_last_kvt_parkings['lng'])
+    # Порог как в прежнем SQL: distance там — угол в радианах, без умножения на радиус Земли
+    near = distance <= 15
+    df_kvt_parking = pd.DataFrame({
+        'city_id': df_last_kvt_bikes['city_id'].to_numpy()[bike_idx[near]],
+        'parking_id': df_last_kvt_parkings['parking_id'].to_numpy()[parking_idx[near]],
+    }).groupby(['city_id', 'parking_id'], dropna=False, sort=False).size().rename('kvt').reset_index()
+
+    # Все активные парковки, КВТ у ближайших, area парковки (по умолчанию 0 / '0')
+    df_t_last_kvt = df_last_kvt_parkings[['city_id', 'parking_id', 'parking_name']] \
+        .rename(columns={'city_id': 'parking_city_id'}) \
+        .merge(df_kvt_parking, how='left', on='parking_id') \
+        .merge(df_areas_parkings, how='left', on='parking_id')
+    # После left merge city_id — float64; Int64, так как city_id у t_bike/t_area может быть NULL
+    df_t_last_kvt['city_id'] = df_t_last_kvt['city_id'].fillna(df_t_last_kvt['parking_city_id']).astype('Int64')
+    df_t_last_kvt['area_id'] = df_t_last_kvt['area_id'].fillna(0).astype('int64')
+    df_t_last_kvt['area_name'] = df_t_last_kvt['area_name'].fillna('0')
+    df_t_last_kvt['kvt'] = df_t_last_kvt['kvt'].fillna(0).astype('int64')
+    df_t_last_kvt = df_t_last_kvt[['city_id', 'area_id', 'area_name', 'parking_id', 'parking_name', 'kvt']]
 
     # Очистка таблицы
     truncate_t_last_kvt = "TRUNCATE TABLE t_last_kvt RESTART IDENTITY;"
 
-    with engine_postgresql.connect() as connection:
-        with connection.begin() as transaction:
-            print(f"Попытка очистить таблицу")
-            # Очистка t_bike
-            connection.execute(sa.text(truncate_t_last_kvt))
-            # Если ошибок нет, транзакция фиксируется автоматически
-            print(f"Таблица truncate_t_last_kvt успешно очищена!")
-
-    df_t_last_kvt.to_sql("t_last_kvt", engine_postgresql, if_exists="append", index=False)
-    print('Таблица t_last_kvt успешно обновлена!')
+    replace_table_rows(engine_postgresql, "t_last_kvt", truncate_t_last_kvt, df_t_last_kvt,
+                       constants={'add_time': pd.Timestamp.now(tz='Europe/Athens').tz_localize(None).to_pydatetime()})
     # Выгрузка t_last_kvt pandas. Конец
 
     # Обновление в Parking metadata в Google Sheets. Начало
     # SPREADSHEET_ID = '1b1lck8cPfqtBAOuzGjMYra6qnCs2dDn4TeUuB4FWHrU'
     SPREADSHEET_ID = '10Mv5KcI_H4jzmY0BI1wnwKqTyfNksSs8TcDGYvKfzK4'
-    CREDENTIALS_FILE = generated_json_file
+    # Учетные данные берутся из переменной окружения, без временного JSON-файла
+    CREDENTIALS = None
 
     # Запрос последних данных из postgresql
     select_parking_metadata = '''
@@ -1424,10 +1829,10 @@ def main():
         ORDER BY dtprs.parking_id ASC
     '''
 
-    df_parking_metadata = pd.read_sql(select_parking_metadata, engine_postgresql)
+    df_parking_metadata = read_sql(select_parking_metadata, engine_postgresql)
 
     # Создаем экземпляр менеджера
-    manager = GoogleSheetsManager(CREDENTIALS_FILE, SPREADSHEET_ID)
+    manager = GoogleSheetsManager(CREDENTIALS, SPREADSHEET_ID)
 
     # Удаление + Загрузка в Google Sheets
     manager.truncate_and_write(
@@ -1492,23 +1897,15 @@ def main():
         WHERE res.timestamp_hour >= (NOW() AT TIME ZONE 'Europe/Athens')::date - INTERVAL '2 day'
         ORDER BY res.timestamp_hour , res.city_id , res.area_id
     '''
-    df_t_area_plan = pd.read_sql(select_t_area_plan, engine_postgresql)
+    df_t_area_plan = read_sql(select_t_area_plan, engine_postgresql)
+    to_int_columns(df_t_area_plan, ['city_id', 'area_id', 'kvt', 'poezdok', 'plan_poezdok'])
 
     # Очистка таблицы
     delete_t_last_kvt = '''
             DELETE FROM damir.t_area_plan
             WHERE damir.t_area_plan."timestamp_hour" >= (NOW() AT TIME ZONE 'Europe/Athens')::date - INTERVAL '2 day';
     '''
-    with engine_postgresql.connect() as connection:
-        with connection.begin() as transaction:
-            print(f"Попытка очистить таблицу")
-            # Очистка t_bike
-            connection.execute(sa.text(delete_t_last_kvt))
-            # Если ошибок нет, транзакция фиксируется автоматически
-            print(f"Таблица t_area_plan успешно очищена!")
-
-    df_t_area_plan.to_sql("t_area_plan", engine_postgresql, if_exists="append", index=False)
-    print('Таблица t_area_plan успешно обновлена!')
+    replace_table_rows(engine_postgresql, "t_area_plan", delete_t_last_kvt, df_t_area_plan)
     # Обновление t_area_plan. Конец
 
     # Обновление t_rebalance_sum_avg_rides_2w. Начало
@@ -1534,21 +1931,12 @@ def main():
         GROUP BY tprs.parking_id
         ORDER BY tprs.parking_id
     '''
-    df_t_rebalance_sum_avg_rides_2w = pd.read_sql(select_t_rebalance_sum_avg_rides_2w, engine_postgresql)
+    df_t_rebalance_sum_avg_rides_2w = read_sql(select_t_rebalance_sum_avg_rides_2w, engine_postgresql)
+    to_int_columns(df_t_rebalance_sum_avg_rides_2w, ['parking_id', 'poezdok_2w'])
 
     # Очистка таблицы
     truncate_t_rebalance_sum_avg_rides_2w = "TRUNCATE TABLE t_rebalance_sum_avg_rides_2w RESTART IDENTITY;"
-    with engine_postgresql.connect() as connection:
-        with connection.begin() as transaction:
-            print(f"Попытка очистить таблицу")
-            # Очистка t_area
-            connection.execute(sa.text(truncate_t_rebalance_sum_avg_rides_2w))
-            # Если ошибок нет, транзакция фиксируется автоматически
-            print(f"Таблица t_rebalance_sum_avg_rides_2w успешно очищена!")
-
-    df_t_rebalance_sum_avg_rides_2w.to_sql("t_rebalance_sum_avg_rides_2w", engine_postgresql, if_exists="append",
-                                           index=False)
-    print('Таблица t_rebalance_sum_avg_rides_2w успешно обновлена!')
+    replace_table_rows(engine_postgresql, "t_rebalance_sum_avg_rides_2w", truncate_t_rebalance_sum_avg_rides_2w, df_t_rebalance_sum_avg_rides_2w)
     # Обновление t_rebalance_sum_avg_rides_2w. Конец
 
     # Выгрузка погоды. Начало
@@ -1564,7 +1952,7 @@ def main():
             0::float AS current_precipitation
         FROM damir.t_city tc  
     '''
-    df_cities_weather = pd.read_sql(select_cities_weather, engine_postgresql)
+    df_cities_weather = read_sql(select_cities_weather, engine_postgresql)
 
     # Setup the Open-Meteo API client with cache and retry on error
     cache_session = requests_cache.CachedSession('.cache', expire_after=3600)
@@ -1593,7 +1981,8 @@ def main():
     # df_cities_weather['current_precipitation'] = df_cities_weather['current_precipitation'].astype(float)
     # df_cities_weather['current_precipitation'] = df_cities_weather['current_temperature_2m'].astype(float)
     df_cities_weather = df_cities_weather.drop(columns=['area_lat', 'area_lng'])
-    df_cities_weather.to_sql("t_cities_weather", engine_postgresql, if_exists="append", index=False)
+    df_cities_weather.to_sql("t_cities_weather", engine_postgresql, if_exists="append", index=False,
+                             method=psql_insert_copy, chunksize=50_000)
     print('Таблица t_cities_weather успешно обновлена!')
     # Выгрузка погоды. Конец
 
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import polyline
+import pytest
+
+import entrypoint
+
+SQUARE = [(0.0, 0.0), (0.0, 1.0), (1.0, 1.0), (1.0, 0.0)]
+SQUARE_FAR = [(10.0, 10.0), (10.0, 11.0), (11.0, 11.0), (11.0, 10.0)]
+
+
+def make_areas(details):
+    df_areas = pd.DataFrame({
+        'area_id': np.arange(1, len(details) + 1),
+        'area_name': [f'| Area | {i}' for i in range(len(details))],
+        'area_detail': details,
+    })
+    df_areas['area_coords'] = df_areas['area_detail'].map(entrypoint.decode_polyline_to_array)
+    return df_areas
+
+
+@pytest.mark.parametrize('use_numba', [True, False])
+@pytest.mark.parametrize('empty_pos', [0, 1, 2])
+def test_empty_polyline_keeps_index_aligned(monkeypatch, use_numba, empty_pos):
+    # Пустая polyline первой, в середине и последней — индекс не падает и не сдвигается
+    details = [polyline.encode(SQUARE), polyline.encode(SQUARE_FAR)]
+    details.insert(empty_pos, '')
+    if not use_numba:
+        monkeypatch.setattr(entrypoint, 'points_in_polys', None)
+    elif entrypoint.points_in_polys is None:
+        pytest.skip('numba не установлена')
+
+    area_index = entrypoint.build_area_index(make_areas(details))
+
+    n = len(details)
+    assert len(area_index['polys']) == n
+    assert area_index['poly_bboxes'].shape == (n, 4)
+    assert len(area_index['poly_offsets']) == n + 1
+    assert area_index['polys'][empty_pos].is_empty
+
+    # polyline кодирует (lat, lng): квадрат SQUARE — lng 0..1, lat 0..1
+    df = pd.DataFrame({'lng': [0.5, 10.5, 5.0], 'lat': [0.5, 10.5, 5.0]})
+    entrypoint.assign_area(df, 'lng', 'lat', area_index)
+
+    ids = list(area_index['area_id'][[i for i in range(n) if i != empty_pos]])
+    assert df['area_id'].tolist() == ids + [0]
+
+
+def test_only_empty_polylines():
+    area_index = entrypoint.build_area_index(make_areas(['', '']))
+    df = pd.DataFrame({'lng': [0.5], 'lat': [0.5]})
+    entrypoint.assign_area(df, 'lng', 'lat', area_index)
+    assert df['area_id'].tolist() == [0]
@@ -0,0 +1,47 @@
+import numpy as np
+import polyline
+import pytest
+
+import entrypoint
+
+POLYLINES = [
+    # Пример из описания формата Google: отрицательные долготы, многобайтовые дельты
+    '_p~iF~ps|U_ulLnnqC_mqNvxq`@',
+    '',
+    polyline.encode([(37.98381, 23.72754)]),
+    polyline.encode([(0.00001, -0.00001)]),
+    polyline.encode([(0.0, 0.0), (0.0, 0.0)]),
+    # Отрицательные дельты по обеим осям и смена знака координат
+    polyline.encode([(38.0, 23.8), (37.9, 23.7), (-0.5, -0.5), (-89.99999, -179.99999)]),
+    # Дельты на границах 5-битных групп: 1, 2, 3 и больше байт на число
+    polyline.encode([(0.0, 0.0), (0.00015, -0.00016), (0.00511, -0.00512), (0.16383, -0.16384),
+                     (5.24287, -5.24288), (89.99999, 179.99999)]),
+]
+
+
+@pytest.fixture(params=['numba', 'python'])
+def decode(request):
+    if request.param == 'numba':
+        if entrypoint.decode_polyline_nb is None:
+            pytest.skip('numba не установлена')
+        return entrypoint.decode_polyline_nb
+    return entrypoint._decode_polyline
+
+
+@pytest.mark.parametrize('encoded', POLYLINES)
+@pytest.mark.parametrize('precision', [5, 6])
+def test_matches_polyline_decode(decode, encoded, precision):
+    got = decode(np.frombuffer(encoded.encode('ascii'), dtype=np.uint8), precision)
+
+    expected = np.array(polyline.decode(encoded, precision, geojson=True), dtype=np.float64).reshape(-1, 2)
+    assert got.shape == expected.shape
+    np.testing.assert_array_equal(got, expected)
+
+
+def test_random_polylines(decode):
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        coords = np.column_stack([rng.uniform(-90, 90, 20), rng.uniform(-180, 180, 20)]).round(5)
+        encoded = polyline.encode([tuple(c) for c in coords])
+        got = decode(np.frombuffer(encoded.encode('ascii'), dtype=np.uint8), 5)
+        np.testing.assert_array_equal(got, np.array(polyline.decode(encoded, geojson=True)))
@@ -0,0 +1,57 @@
+import math
+
+import numpy as np
+import pytest
+
+import entrypoint
+
+
+def nearest_points_sql(lat, lng, ref_lat, ref_lng):
+    # Перебор как в прежнем SQL: CROSS JOIN точек и опорных точек, acos(...) AS distance,
+    # RANK() OVER (PARTITION BY точка ORDER BY distance) = 1. NULL-координаты дают NULL
+    # distance, такие пары в ранг 1 не попадают
+    res = []
+    for i, (b_lat, b_lng) in enumerate(zip(lat, lng)):
+        cand = []
+        for j, (p_lat, p_lng) in enumerate(zip(ref_lat, ref_lng)):
+            if any(math.isnan(v) for v in (b_lat, b_lng, p_lat, p_lng)):
+                continue
+            cos_dist = (math.cos(math.radians(b_lat)) * math.cos(math.radians(p_lat))
+                        * math.cos(math.radians(p_lng) - math.radians(b_lng))
+                        + math.sin(math.radians(b_lat)) * math.sin(math.radians(p_lat)))
+            cand.append((math.acos(max(-1.0, min(1.0, cos_dist))), j))
+        if cand:
+            best = min(d for d, _ in cand)
+            res += [(i, j, d) for d, j in cand if d == best]
+    return res
+
+
+@pytest.mark.parametrize('chunk_elements', [1, 50, 1_000_000])
+def test_matches_sql_rank(chunk_elements):
+    rng = np.random.default_rng(1)
+    lat, lng = rng.uniform(37.9, 38.1, 300), rng.uniform(23.6, 23.8, 300)
+    ref_lat, ref_lng = rng.uniform(37.9, 38.1, 40), rng.uniform(23.6, 23.8, 40)
+    # Ничья: две опорные точки в одном месте, точки ровно на них
+    ref_lat[7], ref_lng[7] = ref_lat[3], ref_lng[3]
+    lat[10], lng[10] = ref_lat[3], ref_lng[3]
+    lat[11], lng[11] = ref_lat[3] + 1e-4, ref_lng[3]
+    # Точки и опорные точки без координат
+    lat[5] = np.nan
+    lng[6] = np.nan
+    ref_lat[12] = np.nan
+
+    point_idx, ref_idx, distance = entrypoint.nearest_points(lat, lng, ref_lat, ref_lng,
+                                                             chunk_elements=chunk_elements)
+
+    got = sorted(zip(point_idx.tolist(), ref_idx.tolist(), distance.tolist()))
+    expected = sorted(nearest_points_sql(lat, lng, ref_lat, ref_lng))
+    assert [(i, j) for i, j, _ in got] == [(i, j) for i, j, _ in expected]
+    np.testing.assert_allclose([d for *_, d in got], [d for *_, d in expected], rtol=0, atol=1e-12)
+    assert (10, 3) in [(i, j) for i, j, _ in got] and (10, 7) in [(i, j) for i, j, _ in got]
+    assert (11, 3) in [(i, j) for i, j, _ in got] and (11, 7) in [(i, j) for i, j, _ in got]
+    assert 5 not in point_idx and 6 not in point_idx and 12 not in ref_idx
+
+
+def test_no_reference_coordinates():
+    point_idx, ref_idx, distance = entrypoint.nearest_points([38.0], [23.7], [np.nan], [23.7])
+    assert len(point_idx) == len(ref_idx) == len(distance) == 0
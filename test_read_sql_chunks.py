@@ -0,0 +1,58 @@
+import sqlite3
+from decimal import Decimal
+
+import pytest
+import sqlalchemy as sa
+
+import entrypoint
+
+# sqlite отдает колонку объявленного типа TEST_DECIMAL как Decimal, как MySQL DECIMAL
+sqlite3.register_converter('TEST_DECIMAL', lambda b: Decimal(b.decode()))
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = sa.create_engine(f'sqlite:///{tmp_path / "t.db"}',
+                              connect_args={'detect_types': sqlite3.PARSE_DECLTYPES})
+    with engine.begin() as connection:
+        connection.execute(sa.text('CREATE TABLE t (id INTEGER, price TEST_DECIMAL)'))
+        connection.execute(sa.text('INSERT INTO t VALUES (:id, :price)'),
+                           [{'id': i, 'price': f'{i}.25'} for i in range(7)])
+    assert not engine.dialect.supports_server_side_cursors
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def invalidated(engine):
+    calls = []
+    sa.event.listen(engine, 'invalidate', lambda *args: calls.append(args))
+    return calls
+
+
+def test_chunks_and_decimal_to_float(engine, invalidated):
+    chunks = list(entrypoint._read_sql_chunks('SELECT id, price FROM t ORDER BY id', engine, 3))
+
+    assert [len(c) for c in chunks] == [3, 3, 1]
+    assert [c['id'].tolist() for c in chunks] == [[0, 1, 2], [3, 4, 5], [6]]
+    assert all(c['price'].dtype == 'float64' for c in chunks)
+    assert chunks[2]['price'].tolist() == [6.25]
+    assert engine.pool.checkedout() == 0
+    assert not invalidated
+
+
+def test_early_stop_invalidates_connection(engine, invalidated):
+    chunks = entrypoint._read_sql_chunks('SELECT id, price FROM t ORDER BY id', engine, 3)
+    assert len(next(chunks)) == 3
+    chunks.close()
+
+    assert invalidated
+    assert engine.pool.checkedout() == 0
+
+
+def test_query_error_is_not_masked(engine, invalidated):
+    with pytest.raises(sqlite3.OperationalError, match='no such table'):
+        list(entrypoint._read_sql_chunks('SELECT * FROM missing', engine, 3))
+
+    assert invalidated
+    assert engine.pool.checkedout() == 0
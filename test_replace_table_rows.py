@@ -0,0 +1,105 @@
+import contextlib
+import datetime
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import entrypoint
+
+
+class FakeConnection:
+    # Запоминает запросы; SHOW TIME ZONE отвечает заданным поясом
+    def __init__(self, session_tz):
+        self.session_tz = session_tz
+        self.connection = None
+        self.executed = []
+
+    def execute(self, statement, params=None):
+        self.executed.append((str(statement), params))
+        session_tz = self.session_tz
+
+        class Result:
+            def scalar(self):
+                return session_tz
+        return Result()
+
+
+class FakeEngine:
+    def __init__(self, session_tz='Europe/Athens'):
+        self.connection = FakeConnection(session_tz)
+
+    def begin(self):
+        return contextlib.nullcontext(self.connection)
+
+
+@pytest.fixture
+def copied(monkeypatch):
+    rows = []
+    monkeypatch.setattr(entrypoint, '_copy_rows',
+                        lambda dbapi_conn, table_name, columns, data: rows.append((table_name, list(columns), list(data))))
+    return rows
+
+
+def test_tz_aware_converted_to_session_time_zone(copied):
+    df = pd.DataFrame({
+        'add_time': pd.to_datetime(['2026-10-15 09:00', None]).tz_localize('UTC'),
+        'v': [1, 2],
+    })
+    engine = FakeEngine('Europe/Athens')
+
+    entrypoint.replace_table_rows(engine, 't', 'DELETE FROM t', df)
+
+    assert engine.connection.executed[0][0] == 'SHOW TIME ZONE'
+    (_, _, rows), = copied
+    assert rows == [(pd.Timestamp('2026-10-15 12:00'), 1), (None, 2)]
+    # Исходный DataFrame не меняется
+    assert str(df['add_time'].dt.tz) == 'UTC'
+
+
+def test_naive_timestamps_skip_session_query(copied):
+    df = pd.DataFrame({'add_time': pd.to_datetime(['2026-10-15 09:00']), 'v': [1]})
+    engine = FakeEngine()
+
+    entrypoint.replace_table_rows(engine, 't', 'DELETE FROM t', df)
+
+    assert all(sql != 'SHOW TIME ZONE' for sql, _ in engine.connection.executed)
+    assert copied[0][2] == [(pd.Timestamp('2026-10-15 09:00'), 1)]
+
+
+def test_int64_na_written_as_null(copied):
+    df = pd.DataFrame({'city_id': [1.0, np.nan], 'kvt': [Decimal('12'), None], 'x': [1.5, np.nan]})
+    entrypoint.to_int_columns(df, ['city_id', 'kvt'])
+
+    entrypoint.replace_table_rows(FakeEngine(), 't', 'DELETE FROM t', df)
+
+    assert str(df['city_id'].dtype) == 'Int64' and str(df['kvt'].dtype) == 'Int64'
+    rows = copied[0][2]
+    assert rows == [(1, 12, 1.5), (None, None, None)]
+    assert type(rows[0][0]) is int and type(rows[0][1]) is int
+
+
+def test_to_int_columns_rejects_fractional():
+    with pytest.raises(TypeError):
+        entrypoint.to_int_columns(pd.DataFrame({'kvt': [1.0, 1.5]}), ['kvt'])
+
+
+def test_insert_select_with_constants(copied):
+    df = pd.DataFrame({'city_id': [1], 'kvt': [3]})
+    add_time = datetime.datetime(2026, 10, 15, 12, 0)
+    engine = FakeEngine()
+
+    entrypoint.replace_table_rows(engine, 't_area_kvt_history', 'DELETE FROM t_area_kvt_history', df,
+                                  constants={'add_time': add_time, 'source': 'job'})
+
+    executed = engine.connection.executed
+    assert executed[0][0] == ('CREATE TEMP TABLE "t_area_kvt_history_stg" ON COMMIT DROP AS '
+                              'SELECT "city_id", "kvt" FROM t_area_kvt_history WITH NO DATA')
+    assert copied[0][:2] == ('"t_area_kvt_history_stg"', ['city_id', 'kvt'])
+    assert executed[1][0] == 'DELETE FROM t_area_kvt_history'
+    assert executed[2] == (
+        'INSERT INTO t_area_kvt_history ("city_id", "kvt", "add_time", "source") '
+        'SELECT "city_id", "kvt", :const_0, :const_1 FROM "t_area_kvt_history_stg"',
+        {'const_0': add_time, 'const_1': 'job'},
+    )
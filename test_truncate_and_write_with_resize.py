@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+import entrypoint
+
+
+class FakeService:
+    # Минимум spreadsheets() для truncate_and_write_with_resize: get и batchUpdate
+    def __init__(self):
+        self.bodies = []
+
+    def spreadsheets(self):
+        return self
+
+    def get(self, **kwargs):
+        return FakeRequest({'sheets': [{'properties': {
+            'sheetId': 7, 'title': 'Sheet1', 'gridProperties': {'rowCount': 100, 'columnCount': 5}}}]})
+
+    def batchUpdate(self, spreadsheetId, body):
+        self.bodies.append(body)
+        return FakeRequest({})
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+def make_manager():
+    manager = entrypoint.GoogleSheetsManager.__new__(entrypoint.GoogleSheetsManager)
+    manager.spreadsheet_id = 'id'
+    manager.service = FakeService()
+    return manager
+
+
+def test_rows_split_into_update_cells_blocks():
+    manager = make_manager()
+    df = pd.DataFrame({'a': range(7), 'b': [f's{i}' for i in range(7)]})
+
+    assert manager.truncate_and_write_with_resize(df, start_cell='B3', chunk_rows=3)
+
+    body, = manager.service.bodies
+    updates = [r['updateCells'] for r in body['requests'] if 'updateCells' in r]
+    # Заголовок + 7 строк = 8 строк: блоки 3, 3, 2
+    assert [len(u['rows']) for u in updates] == [3, 3, 2]
+    assert [u['start'] for u in updates] == [
+        {'sheetId': 7, 'rowIndex': 2 + i, 'columnIndex': 1} for i in (0, 3, 6)
+    ]
+    rows = [row for u in updates for row in u['rows']]
+    assert rows[0]['values'][0] == {'userEnteredValue': {'stringValue': 'a'}}
+    assert rows[-1]['values'] == [{'userEnteredValue': {'numberValue': 6}},
+                                  {'userEnteredValue': {'stringValue': 's6'}}]
+
+
+def test_cell_data_non_finite_floats_are_empty():
+    assert entrypoint.GoogleSheetsManager._cell_data(np.inf) == {}
+    assert entrypoint.GoogleSheetsManager._cell_data(-np.inf) == {}
+    assert entrypoint.GoogleSheetsManager._cell_data(float('nan')) == {}
+    assert entrypoint.GoogleSheetsManager._cell_data(1.5) == {'userEnteredValue': {'numberValue': 1.5}}
+    assert entrypoint.GoogleSheetsManager._cell_data(True) == {'userEnteredValue': {'boolValue': True}}